@@ -0,0 +1,193 @@
+"""
+An in-process stand-in for the elasticsearch endpoints the client uses
+"""
+import json
+import random
+import zlib
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+
+class FakeElasticSearch(resource.Resource):
+    """
+    Answer /_bulk, /_search, /_search/scroll, /_mget, /_msearch,
+    /_cluster/nodes, /_cluster/health and single document gets with
+    canned responses.
+
+     - latency: seconds to wait before answering each request
+     - errorRate: fraction of the requests answered with a 503
+     - rejectRate: fraction of the bulk items rejected with a 429
+     - hits: number of hits in each search or scroll page
+     - pages: number of scroll pages before the scroll is exhausted
+     - docSize: approximate size in bytes of each document source
+
+    Random decisions come from a generator seeded with seed so that runs
+    are reproducible.
+    """
+    isLeaf = True
+
+    def __init__(self, latency=0, errorRate=0, rejectRate=0, hits=10,
+                 pages=10, docSize=512, seed=0):
+        resource.Resource.__init__(self)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.rejectRate = rejectRate
+        self.hits = hits
+        self.pages = pages
+        self.docSize = docSize
+        self.random = random.Random(seed)
+        self.address = None
+        self.requests = 0
+        self.errors = 0
+        self.indexed = 0
+
+    def makeSource(self, id):
+        return {"id": id, "body": "x" * self.docSize}
+
+    def makeHit(self, index, id):
+        return {"_index": index, "_type": "doc", "_id": str(id),
+                "_score": 1.0, "_source": self.makeSource(id)}
+
+    def render(self, request):
+        def finish():
+            if request._disconnected:
+                return
+            request.write(self.respond(request, body))
+            request.finish()
+
+        self.requests += 1
+        body = request.content.read()
+        if request.getHeader("content-encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        request.setHeader("content-type", "application/json")
+        if self.errorRate and self.random.random() < self.errorRate:
+            self.errors += 1
+            request.setResponseCode(503)
+            return json.dumps({"error": "EsRejectedExecutionException[busy]",
+                               "status": 503})
+
+        if not self.latency:
+            return self.respond(request, body)
+        reactor.callLater(self.latency, finish)
+        return server.NOT_DONE_YET
+
+    def respond(self, request, body):
+        parts = [part for part in request.path.split("/") if part]
+        if not parts:
+            return json.dumps({"ok": True, "name": "fake",
+                               "version": {"number": "0.90.0"}})
+
+        if parts[0] == "_cluster":
+            if parts[1:] == ["nodes"]:
+                return self.clusterNodes()
+            if parts[1:] == ["health"]:
+                return json.dumps({"cluster_name": "fake",
+                                   "status": "green",
+                                   "number_of_nodes": 1})
+        if parts == ["_bulk"]:
+            return self.bulk(body)
+        if parts == ["_mget"]:
+            return self.mget(body)
+        if parts == ["_msearch"]:
+            return self.msearch(body)
+        if parts == ["_search", "scroll"]:
+            return self.scroll(request, body)
+        if parts[-1] == "_search":
+            return self.search(request, parts[0])
+        if len(parts) == 3 and not parts[2].startswith("_"):
+            return json.dumps({"_index": parts[0], "_type": parts[1],
+                               "_id": parts[2], "_version": 1,
+                               "exists": True,
+                               "_source": self.makeSource(parts[2])})
+        return json.dumps({"ok": True, "acknowledged": True})
+
+    def clusterNodes(self):
+        nodes = {"fake": {"name": "fake",
+                          "http_address": "inet[/%s]" % self.address}}
+        return json.dumps({"cluster_name": "fake", "nodes": nodes})
+
+    def bulk(self, body):
+        items = []
+        for line in body.split("\n"):
+            if not line:
+                continue
+            action = json.loads(line)
+            opType = action.keys()[0]
+            if opType not in ("index", "create", "delete"):
+                continue
+            meta = action[opType]
+            item = {"_index": meta.get("_index"), "_type": meta.get("_type"),
+                    "_id": meta.get("_id"), "_version": 1, "ok": True}
+            if self.rejectRate and self.random.random() < self.rejectRate:
+                item = {"_index": meta.get("_index"),
+                        "_type": meta.get("_type"), "_id": meta.get("_id"),
+                        "status": 429,
+                        "error": "EsRejectedExecutionException[busy]"}
+            else:
+                self.indexed += 1
+            items.append({opType: item})
+        return json.dumps({"took": 1, "items": items})
+
+    def mget(self, body):
+        docs = []
+        for doc in json.loads(body)["docs"]:
+            docs.append({"_index": doc["_index"], "_type": doc["_type"],
+                         "_id": doc["_id"], "_version": 1, "exists": True,
+                         "_source": self.makeSource(doc["_id"])})
+        return json.dumps({"docs": docs})
+
+    def msearch(self, body):
+        lines = [line for line in body.split("\n") if line]
+        responses = []
+        for header in lines[::2]:
+            index = json.loads(header).get("index", "_all")
+            hits = [self.makeHit(index, i) for i in range(self.hits)]
+            responses.append({"took": 1, "timed_out": False,
+                              "hits": {"total": self.hits * self.pages,
+                                       "max_score": 1.0, "hits": hits}})
+        return json.dumps({"responses": responses})
+
+    def search(self, request, index):
+        total = self.hits * self.pages
+        if request.args.get("search_type") == ["scan"]:
+            return json.dumps({"_scroll_id": "0", "took": 1,
+                               "hits": {"total": total, "hits": []}})
+
+        hits = [self.makeHit(index, i) for i in range(self.hits)]
+        scrollId = None
+        if "scroll" in request.args:
+            scrollId = "1"
+        response = {"took": 1, "timed_out": False,
+                    "_shards": {"total": 1, "successful": 1, "failed": 0},
+                    "hits": {"total": total, "max_score": 1.0,
+                             "hits": hits}}
+        if scrollId:
+            response["_scroll_id"] = scrollId
+        return json.dumps(response)
+
+    def scroll(self, request, body):
+        if request.method == "DELETE":
+            return json.dumps({"ok": True})
+
+        page = int(body or 0)
+        hits = []
+        if page < self.pages:
+            start = page * self.hits
+            hits = [self.makeHit("scroll", i)
+                    for i in range(start, start + self.hits)]
+        return json.dumps({"_scroll_id": str(page + 1), "took": 1,
+                           "hits": {"total": self.hits * self.pages,
+                                    "hits": hits}})
+
+
+def start(port=0, **kwargs):
+    """
+    Listen on a local port and return the fake along with the port
+    """
+    fake = FakeElasticSearch(**kwargs)
+    site = server.Site(fake)
+    site.noisy = False
+    port = reactor.listenTCP(port, site, interface="127.0.0.1")
+    fake.address = "127.0.0.1:%d" % port.getHost().port
+    return fake, port
@@ -0,0 +1,299 @@
+"""
+Benchmark the client against an in-process fake elasticsearch.
+
+Every scenario runs in its own process so that its peak memory is not
+inflated by the ones before it. Run from the top of the source tree:
+
+    python -m benchmarks.run --output after.json --compare before.json
+
+Run with --help for the scenarios and their options.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from twisted.internet import defer, task
+
+from benchmarks import fakees
+from txes import elasticsearch
+
+
+SCENARIOS = ("bulk", "get", "search", "scroll")
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    index = int(len(values) * percent / 100.0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(name, operations, elapsed, latencies, errors):
+    """
+    Return the throughput and latency percentiles of a scenario from the
+    number of operations that succeeded, latencies are in milliseconds
+    """
+    latencies = sorted(latencies)
+    return {"scenario": name,
+            "operations": operations,
+            "errors": errors,
+            "elapsed": elapsed,
+            "throughput": operations / elapsed if elapsed else None,
+            "latency": {"p50": percentile(latencies, 50) * 1000,
+                        "p90": percentile(latencies, 90) * 1000,
+                        "p99": percentile(latencies, 99) * 1000,
+                        "max": latencies[-1] * 1000}
+            if latencies else {}}
+
+
+def runWorkers(count, operations, operation):
+    """
+    Call operation operations times with at most count calls in flight,
+    return the latency of every call and the number of failed calls
+    """
+    latencies = []
+    errors = [0]
+
+    def timed(i):
+        def done(_):
+            latencies.append(time.time() - started)
+
+        def failed(reason):
+            errors[0] += 1
+
+        started = time.time()
+        d = defer.maybeDeferred(operation, i)
+        d.addCallbacks(done, failed)
+        return d
+
+    work = iter(xrange(operations))
+    cooperator = task.Cooperator()
+    workers = [cooperator.coiterate(timed(i) for i in work)
+               for _ in xrange(count)]
+    d = defer.DeferredList(workers)
+    d.addCallback(lambda _: (latencies, errors[0]))
+    return d
+
+
+@defer.inlineCallbacks
+def benchBulk(es, fake, options):
+    """
+    Index documents with bulk requests, errors are the operations the
+    fake never indexed because their bulk request failed or because they
+    were rejected on every attempt
+    """
+    latencies = []
+
+    def traced(trace):
+        if trace.path == "/_bulk" and trace.error is None:
+            latencies.append(trace.duration)
+
+    es.addRequestHooks(after=traced)
+    started = time.time()
+    for i in xrange(options.operations):
+        try:
+            yield es.index({"id": i, "body": "x" * options.doc_size},
+                           "bench", "doc", i + 1, bulk=True)
+        except Exception:
+            pass
+    try:
+        yield es.forceBulk()
+    except Exception:
+        pass
+    elapsed = time.time() - started
+    defer.returnValue(summarize("bulk", fake.indexed, elapsed, latencies,
+                                options.operations - fake.indexed))
+
+
+@defer.inlineCallbacks
+def benchGet(es, fake, options):
+    def get(i):
+        return es.get("bench", "doc", i % 1000 + 1)
+
+    started = time.time()
+    latencies, errors = yield runWorkers(options.concurrency,
+                                         options.operations, get)
+    elapsed = time.time() - started
+    defer.returnValue(summarize("get", len(latencies), elapsed, latencies,
+                                errors))
+
+
+@defer.inlineCallbacks
+def benchSearch(es, fake, options):
+    def search(i):
+        return es.search({"query": {"term": {"id": i % 100}}}, "bench")
+
+    started = time.time()
+    latencies, errors = yield runWorkers(options.concurrency,
+                                         options.operations, search)
+    elapsed = time.time() - started
+    defer.returnValue(summarize("search", len(latencies), elapsed,
+                                latencies, errors))
+
+
+@defer.inlineCallbacks
+def benchScroll(es, fake, options):
+    latencies = []
+    hits = 0
+    errors = 0
+
+    started = last = time.time()
+    try:
+        scroller = yield es.scan({"query": {"match_all": {}}}, "bench",
+                                 prefetch=options.prefetch)
+        while True:
+            results = yield scroller.next()
+            if results is None:
+                break
+            now = time.time()
+            latencies.append(now - last)
+            last = now
+            hits += len(results["hits"]["hits"])
+    except Exception:
+        errors += 1
+    elapsed = time.time() - started
+    defer.returnValue(summarize("scroll", hits, elapsed, latencies, errors))
+
+
+BENCHMARKS = {"bulk": benchBulk,
+              "get": benchGet,
+              "search": benchSearch,
+              "scroll": benchScroll}
+
+
+@defer.inlineCallbacks
+def runScenario(reactor, options):
+    fake, port = fakees.start(latency=options.latency,
+                              errorRate=options.error_rate,
+                              rejectRate=options.reject_rate,
+                              hits=options.hits, pages=options.pages,
+                              docSize=options.doc_size, seed=options.seed)
+    es = elasticsearch.ElasticSearch(
+        fake.address, discover=False, bulkSize=options.bulk_size,
+        bulkConcurrency=options.concurrency, mgetWindow=options.mget_window,
+        msearchWindow=options.msearch_window, compress=options.compress,
+        codec=options.codec)
+    try:
+        result = yield BENCHMARKS[options.child](es, fake, options)
+    finally:
+        yield es.close()
+        yield port.stopListening()
+
+    result["requests"] = fake.requests
+    result["injectedErrors"] = fake.errors
+    result["peakMemoryKB"] = resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps(result)
+
+
+def spawn(scenario, argv):
+    """
+    Run scenario in a child process and return its result
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    command = [sys.executable, "-m", "benchmarks.run", "--child", scenario]
+    output = subprocess.check_output(command + argv, cwd=root)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def describe(result):
+    latency = result["latency"]
+    return ("%-7s %9.1f ops/s  p50 %7.2fms  p90 %7.2fms  p99 %7.2fms  "
+            "errors %d  peak %dKB" % (result["scenario"],
+                                      result["throughput"] or 0,
+                                      latency.get("p50") or 0,
+                                      latency.get("p90") or 0,
+                                      latency.get("p99") or 0,
+                                      result["errors"],
+                                      result["peakMemoryKB"]))
+
+
+def compare(results, baseline):
+    before = dict((r["scenario"], r) for r in baseline["results"])
+    for result in results:
+        old = before.get(result["scenario"])
+        if not old or not old["throughput"]:
+            continue
+        change = (result["throughput"] / old["throughput"] - 1) * 100
+        print "%-7s throughput %+.1f%%  p99 %.2fms -> %.2fms" % (
+            result["scenario"], change, old["latency"].get("p99") or 0,
+            result["latency"].get("p99") or 0)
+
+
+def parseArgs(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="scenarios to run out of %s, all of them by "
+                        "default" % ", ".join(SCENARIOS))
+    parser.add_argument("--operations", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0,
+                        help="seconds the fake waits before answering")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="fraction of requests answered with a 503")
+    parser.add_argument("--reject-rate", type=float, default=0,
+                        help="fraction of bulk items rejected with a 429")
+    parser.add_argument("--doc-size", type=int, default=512)
+    parser.add_argument("--hits", type=int, default=10,
+                        help="hits per search or scroll page")
+    parser.add_argument("--pages", type=int, default=100,
+                        help="scroll pages")
+    parser.add_argument("--prefetch", type=int, default=1)
+    parser.add_argument("--bulk-size", type=int, default=400)
+    parser.add_argument("--mget-window", type=float, default=None)
+    parser.add_argument("--msearch-window", type=float, default=None)
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--codec", default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="save the results to this file")
+    parser.add_argument("--compare",
+                        help="compare with the results saved in this file")
+    parser.add_argument("--child", choices=SCENARIOS, help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    for scenario in options.scenarios:
+        if scenario not in SCENARIOS:
+            parser.error("unknown scenario %s" % scenario)
+    if not options.scenarios:
+        options.scenarios = list(SCENARIOS)
+    return options
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options = parseArgs(args)
+    if options.child:
+        task.react(runScenario, [options])
+        return
+
+    childArgs = [arg for arg in args if arg not in options.scenarios]
+    results = []
+    for scenario in options.scenarios:
+        result = spawn(scenario, childArgs)
+        print describe(result)
+        results.append(result)
+
+    settings = dict(vars(options))
+    for key in ("scenarios", "output", "compare", "child"):
+        settings.pop(key)
+    report = {"timestamp": time.time(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "settings": settings,
+              "results": results}
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
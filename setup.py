@@ -14,12 +14,12 @@ setup(name='txes',
       author_email='jason@koelker.net',
       url='https://github.com/jkoelker/txes',
       license='BSD License',
-      packages=find_packages(exclude=['ez_setup', 'examples', 'tests']),
+      packages=find_packages(exclude=['ez_setup', 'examples', 'tests',
+                                      'benchmarks']),
       include_package_data=True,
       zip_safe=False,
       install_requires=[
           "twisted",
-          "anyjson"
       ],
       entry_points="""
       # -*- Entry points: -*-
@@ -0,0 +1,73 @@
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
+
+class Batcher(object):
+    """
+    Collect the items added within window seconds, or until maxSize of
+    them are waiting, and hand them to send as a single batch.
+
+    send is called with the list of items and must return a deferred
+    firing with a result for each of them, in order. An exception in the
+    results fails the deferred of its item alone, while a failure of the
+    whole batch fails all of them.
+    """
+    def __init__(self, send, window=0.005, maxSize=100):
+        self.send = send
+        self.window = window
+        self.maxSize = maxSize
+        self.items = []
+        self.waiters = []
+        self.call = None
+        self.stats = {"batches": 0, "items": 0}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        """
+        Queue item and return a deferred firing with its result
+        """
+        d = defer.Deferred()
+        self.items.append(item)
+        self.waiters.append(d)
+        if len(self.items) >= self.maxSize:
+            self.flush()
+        elif self.call is None:
+            self.call = reactor.callLater(self.window, self.flush)
+        return d
+
+    def flush(self):
+        """
+        Send the queued items now, the returned deferred fires once their
+        results have been delivered
+        """
+        def deliver(results):
+            for waiter, result in zip(waiters, results):
+                if waiter.called:
+                    continue
+                if isinstance(result, Exception):
+                    waiter.errback(failure.Failure(result))
+                else:
+                    waiter.callback(result)
+
+        def failed(reason):
+            for waiter in waiters:
+                if not waiter.called:
+                    waiter.errback(reason)
+
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+        if not self.items:
+            return defer.succeed(None)
+
+        items, self.items = self.items, []
+        waiters, self.waiters = self.waiters, []
+        self.stats["batches"] += 1
+        self.stats["items"] += len(items)
+
+        d = defer.maybeDeferred(self.send, items)
+        d.addCallbacks(deliver, failed)
+        return d
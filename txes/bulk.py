@@ -0,0 +1,41 @@
+from txes import exceptions
+
+
+RETRY_STATUSES = (429, 503)
+
+
+def retryable(exc):
+    """
+    Return True if a failed bulk item may succeed when sent again
+    """
+    if isinstance(exc, exceptions.EsRejectedExecutionException):
+        return True
+    return exc.status in RETRY_STATUSES
+
+
+def itemException(item):
+    """
+    Return the exception for a single item of a bulk response or None if
+    the operation succeeded
+    """
+    result = item.values()[0]
+    if "error" not in result:
+        return None
+    return exceptions.convertException(result.get("status", 500), result)
+
+
+class BulkResult(dict):
+    """
+    Summary of a bulk request.
+
+     - items: the response item of every operation that succeeded
+     - errors: a list of (action, exception) for every operation that
+               failed permanently
+     - retried: the number of operations that were sent again
+    """
+    def __init__(self):
+        dict.__init__(self, items=[], errors=[], retried=0)
+
+    @property
+    def ok(self):
+        return not self["errors"]
@@ -0,0 +1,118 @@
+import collections
+import copy
+import time
+
+from twisted.internet import defer
+
+
+ENDPOINTS = ("mapping", "state", "status")
+
+
+def isBroad(names):
+    """
+    Return True if names may match indices that are not named explicitly
+    """
+    if not names:
+        return True
+    for name in names:
+        if name == "_all" or "*" in name:
+            return True
+    return False
+
+
+class MetadataCache(object):
+    """
+    Keep the responses of the metadata endpoints for a while.
+
+    ttls maps an endpoint from ENDPOINTS to the number of seconds its
+    responses are kept for, endpoints missing from it are not cached. A
+    single number applies to all of them. Once maxSize responses are kept
+    the least recently used one is dropped.
+
+    Every response is tagged with the indices it was requested for and
+    the concrete indices it returned so invalidate() only drops the ones
+    a change may affect.
+    """
+    def __init__(self, ttls, maxSize=1000):
+        if not isinstance(ttls, dict):
+            ttls = dict((endpoint, ttls) for endpoint in ENDPOINTS)
+        for endpoint in ttls:
+            if endpoint not in ENDPOINTS:
+                raise ValueError("Invalid cache endpoint: %s" % endpoint)
+        self.ttls = ttls
+        self.maxSize = maxSize
+        self.entries = collections.OrderedDict()
+        self.generation = 0
+        self.stats = {"hits": 0,
+                      "misses": 0,
+                      "expired": 0,
+                      "evictions": 0,
+                      "invalidations": 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def fetch(self, endpoint, key, names, request, tags=None):
+        """
+        Return a deferred firing with a copy of the cached response for
+        key or call request to get it.
+
+        names are the indices the request is for and tags, when given, is
+        called with the response to return the indices it covers.
+        """
+        def store(result):
+            if self.generation == generation:
+                indices = set(names or ())
+                if tags is not None:
+                    indices.update(tags(result))
+                self._store(key, result, indices, isBroad(names),
+                            time.time() + ttl)
+            return result
+
+        ttl = self.ttls.get(endpoint)
+        if not ttl:
+            return request()
+
+        key = (endpoint, key)
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            if entry[0] > time.time():
+                self.entries[key] = entry
+                self.stats["hits"] += 1
+                return defer.succeed(copy.deepcopy(entry[1]))
+            self.stats["expired"] += 1
+
+        self.stats["misses"] += 1
+        generation = self.generation
+        d = request()
+        d.addCallback(store)
+        return d
+
+    def _store(self, key, result, indices, broad, expires):
+        self.entries.pop(key, None)
+        self.entries[key] = (expires, copy.deepcopy(result), indices, broad)
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def invalidate(self, indices=None):
+        """
+        Drop the responses covering any of indices along with the ones
+        requested for _all or a wildcard, or everything without indices
+        """
+        self.generation += 1
+        if not indices or isBroad(indices):
+            self.stats["invalidations"] += len(self.entries)
+            self.entries.clear()
+            return
+
+        indices = set(indices)
+        for key, entry in self.entries.items():
+            if entry[3] or entry[2] & indices:
+                del self.entries[key]
+                self.stats["invalidations"] += 1
+
+    def getStats(self):
+        stats = dict(self.stats)
+        stats["size"] = len(self.entries)
+        return stats
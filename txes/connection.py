@@ -8,10 +8,12 @@ from txes import connection_http, exceptions
 from txes import interfaces
 
 
-def connect(servers=None, timeout=None, retryTime=10, connection=None):
+def connect(servers=None, timeout=None, retryTime=10, connection=None,
+            **kwargs):
     if not connection:
         connection = connection_http.HTTPConnection()
 
     verify.verifyObject(interfaces.IConnection, connection)
-    connection.connect(servers=servers, timeout=timeout, retryTime=retryTime)
+    connection.connect(servers=servers, timeout=timeout, retryTime=retryTime,
+                       **kwargs)
     return connection
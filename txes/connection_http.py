@@ -1,30 +1,100 @@
-import codecs
-try:
-    import cStringIO as StringIO
-except ImportError:
-    import StringIO
+import collections
+import time
 import urllib
+import zlib
 
-import anyjson
-
-from twisted.internet import defer, reactor, protocol
+from twisted.internet import defer, error, reactor, protocol, task
+from twisted.internet import interfaces as iinternet
+from twisted.python import components, failure, log
 from twisted.web import client
 from twisted.web import iweb
 from twisted.web import http
+from twisted.web import http_headers
 from zope import interface
 
-from txes import exceptions, interfaces, utils
+from txes import exceptions, interfaces, jsoncodec, jsonstream, metrics
+from txes import tracing, utils
 
 
 DEFAULT_SERVER = "127.0.0.1:9200"
 
+PROBE_TIMEOUT = 5
+
+IDEMPOTENT_METHODS = ("GET", "HEAD", "PUT", "DELETE", "OPTIONS")
+
+READ_METHODS = ("GET", "HEAD")
+
+# Reads which move a cursor forward on the server, sending one of them
+# twice skips a page of results
+SCROLL_PATH = "/_search/scroll"
+
+# Failures where the request never reached the server
+CONNECT_ERRORS = (error.ConnectError, error.DNSLookupError,
+                  error.ConnectingCancelledError, client.RequestNotSent)
+
+# Failures where the server may or may not have processed the request
+TRANSPORT_ERRORS = (error.ConnectionLost, client.ResponseFailed,
+                    client.ResponseNeverReceived,
+                    client.RequestTransmissionFailed,
+                    exceptions.RequestTimeout)
+
+
+class HTTPConnectionPool(client.HTTPConnectionPool):
+    """
+    Persistent connection pool which keeps count of how often a cached
+    connection was reused instead of opening a new one.
+
+    When span is set while a request is handed to the agent, the end of
+    its connect phase is marked once it has a connection.
+    """
+    def __init__(self, reactor, persistent=True):
+        client.HTTPConnectionPool.__init__(self, reactor, persistent)
+        self.requested = 0
+        self.created = 0
+        self.span = None
+
+    def getConnection(self, key, endpoint):
+        def connected(connection, span):
+            span.mark("connect")
+            return connection
+
+        self.requested += 1
+        d = client.HTTPConnectionPool.getConnection(self, key, endpoint)
+        if self.span is not None:
+            d.addCallback(connected, self.span)
+        return d
+
+    def _newConnection(self, key, endpoint):
+        self.created += 1
+        return client.HTTPConnectionPool._newConnection(self, key, endpoint)
+
+    def stats(self):
+        idle = {}
+        for key, connections in self._connections.iteritems():
+            idle["%s:%s" % key[-2:]] = len(connections)
+        return {"requested": self.requested,
+                "created": self.created,
+                "reused": self.requested - self.created,
+                "idle": idle}
+
+
+def gzipBody(body, level=6):
+    """
+    Return body compressed in the gzip format
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
 
 class StringProducer(object):
     interface.implements(iweb.IBodyProducer)
 
-    def __init__(self, body):
+    def __init__(self, body, contentEncoding=None):
+        if isinstance(body, unicode):
+            body = body.encode("utf-8")
         self.body = body
         self.length = len(self.body)
+        self.contentEncoding = contentEncoding
 
     def startProducing(self, consumer):
         return defer.maybeDeferred(consumer.write, self.body)
@@ -36,85 +106,730 @@ class StringProducer(object):
         pass
 
 
-class JSONProducer(StringProducer):
-    def __init__(self, body):
-        StringProducer.__init__(self, anyjson.serialize(body))
+class BulkProducer(object):
+    """
+    Write newline delimited bulk lines to the consumer in chunks of about
+    chunkSize bytes, pausing and resuming along with the transport
+    """
+    interface.implements(iweb.IBodyProducer)
+
+    def __init__(self, lines, chunkSize=65536, cooperator=task):
+        self.lines = lines
+        self.chunkSize = chunkSize
+        self.length = sum([len(line) + 1 for line in lines])
+        self._cooperate = cooperator.cooperate
+        self._task = None
+        self._finished = False
+
+    def _chunks(self):
+        chunk = []
+        size = 0
+        for line in self.lines:
+            chunk.append(line)
+            chunk.append("\n")
+            size += len(line) + 1
+            if size >= self.chunkSize:
+                yield "".join(chunk)
+                chunk = []
+                size = 0
+        if chunk:
+            yield "".join(chunk)
+
+    def _writeTo(self, consumer):
+        for chunk in self._chunks():
+            consumer.write(chunk)
+            yield None
+
+    def startProducing(self, consumer):
+        def finished(result):
+            self._finished = True
+            return result
+
+        def maybeStopped(reason):
+            reason.trap(task.TaskStopped)
+            return defer.Deferred()
+
+        self._task = self._cooperate(self._writeTo(consumer))
+        d = self._task.whenDone()
+        d.addBoth(finished)
+        d.addCallbacks(lambda _: None, maybeStopped)
+        return d
+
+    # The transport may still pause or stop the producer once all of the
+    # lines are written, such as while a compressed body is being flushed
+
+    def pauseProducing(self):
+        if not self._finished:
+            self._task.pause()
+
+    def resumeProducing(self):
+        if not self._finished:
+            self._task.resume()
+
+    def stopProducing(self):
+        if not self._finished:
+            self._task.stop()
+
+
+class GzipConsumer(object):
+    """
+    Compress what is written before handing it to the consumer
+    """
+    def __init__(self, consumer, compressor, stats):
+        self.consumer = consumer
+        self.compressor = compressor
+        self.stats = stats
+
+    def write(self, data):
+        self.stats["requestBytes"] += len(data)
+        data = self.compressor.compress(data)
+        if data:
+            self.stats["compressedRequestBytes"] += len(data)
+            self.consumer.write(data)
+
+    def flush(self):
+        data = self.compressor.flush()
+        self.stats["compressedRequestBytes"] += len(data)
+        self.consumer.write(data)
+
+
+class GzipProducer(object):
+    """
+    Compress the body written by another producer with gzip as it is
+    produced. The compressed length is not known up front so the body
+    is sent chunked.
+    """
+    interface.implements(iweb.IBodyProducer)
+
+    contentEncoding = "gzip"
+    length = iweb.UNKNOWN_LENGTH
+
+    def __init__(self, producer, level=6, stats=None):
+        self.producer = producer
+        self.level = level
+        self.stats = stats
+
+    def startProducing(self, consumer):
+        def flush(result):
+            gzipConsumer.flush()
+            return result
+
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        gzipConsumer = GzipConsumer(consumer, compressor, self.stats)
+        d = self.producer.startProducing(gzipConsumer)
+        d.addCallback(flush)
+        return d
+
+    def pauseProducing(self):
+        self.producer.pauseProducing()
+
+    def resumeProducing(self):
+        self.producer.resumeProducing()
+
+    def stopProducing(self):
+        self.producer.stopProducing()
+
+
+class CountingProtocol(components.proxyForInterface(iinternet.IProtocol)):
+    """
+    Add the number of bytes received to stats[key]
+    """
+    def __init__(self, original, stats, key):
+        self.original = original
+        self.stats = stats
+        self.key = key
+
+    def dataReceived(self, data):
+        self.stats[self.key] += len(data)
+        self.original.dataReceived(data)
+
+
+class CountingResponse(components.proxyForInterface(iweb.IResponse)):
+    """
+    Count the bytes of the body as they come off the wire
+    """
+    def __init__(self, original, stats, key):
+        self.original = original
+        self.stats = stats
+        self.key = key
+
+    def deliverBody(self, protocol):
+        self.original.deliverBody(CountingProtocol(protocol, self.stats,
+                                                   self.key))
+
+
+class GzipDecoder(client.GzipDecoder):
+    """
+    Decompress gzip responses, keeping count of their size before and
+    after decompression
+    """
+    def __init__(self, response, stats):
+        stats["compressedResponses"] += 1
+        response = CountingResponse(response, stats,
+                                    "compressedResponseBytes")
+        client.GzipDecoder.__init__(self, response)
+        self.stats = stats
+
+    def deliverBody(self, protocol):
+        protocol = CountingProtocol(protocol, self.stats, "responseBytes")
+        client.GzipDecoder.deliverBody(self, protocol)
 
 
 class JSONReceiver(protocol.Protocol):
-    def __init__(self, deferred):
+    """
+    Collect a JSON response body and fire the deferred with it decoded.
+
+    With a hitCallback the body is scanned as it arrives and every search
+    hit is handed to the callback on its own, the deferred then fires with
+    the rest of the response.
+
+    With a span the end of the transfer and decode phases are marked on it.
+    """
+    def __init__(self, deferred, codec, hitCallback=None, span=None):
         self.deferred = deferred
-        self.writter = codecs.getwriter("utf_8")(StringIO.StringIO())
+        self.codec = codec
+        self.span = span
+        self.chunks = []
+        self.stream = None
+        self.received = 0
+        if hitCallback:
+            self.stream = jsonstream.HitStream(hitCallback, codec.decode)
 
     def dataReceived(self, bytes):
-        self.writter.write(bytes)
+        self.received += len(bytes)
+        if self.stream:
+            self.stream.feed(bytes)
+        else:
+            self.chunks.append(bytes)
 
     def connectionLost(self, reason):
+        def decodeFailed(failure):
+            failure.trap(ValueError)
+            return {"error": reason}
+
+        def decoded(result):
+            self.span.mark("decode")
+            return result
+
+        if self.deferred.called:
+            return
+
+        if self.span is not None:
+            self.span.mark("transfer")
+            self.span.responseBytes = self.received
+
         if reason.check(client.ResponseDone, http.PotentialDataLoss):
-            try:
-                data = anyjson.deserialize(self.writter.getvalue())
-            except ValueError:
-                data = {"error": reason}
-            self.deferred.callback(data)
+            if self.stream:
+                d = defer.maybeDeferred(self.stream.finish)
+            else:
+                d = self.codec.decodeLater("".join(self.chunks))
+            if self.span is not None:
+                d.addBoth(decoded)
+            d.addErrback(decodeFailed)
+            d.chainDeferred(self.deferred)
         else:
-            self.deffered.errback(reason)
+            self.deferred.errback(reason)
 
 
 class HTTPConnection(object):
     interface.implements(interfaces.IConnection)
 
     def addServer(self, server):
-        if server not in self.servers:
-            self.servers.append(server)
+        self.servers.add(server)
+
+    def setServers(self, servers):
+        self.servers.update(servers)
 
     def getAgent(self):
         try:
             return self.client
         except AttributeError:
-            self.client = client.Agent(reactor)
+            self.client = client.Agent(reactor, pool=self.pool)
+            if self.compress:
+                def decoder(response):
+                    return GzipDecoder(response, self.compression)
+
+                self.client = client.ContentDecoderAgent(self.client,
+                                                         [("gzip", decoder)])
             return self.client
 
     def connect(self, servers=None, timeout=None, retryTime=10,
-                *args, **kwargs):
+                persistent=True, maxIdlePerServer=2, maxOpenPerServer=None,
+                idleTimeout=240, codec=None, offloadThreshold=None,
+                offloadThreads=4, balancer=None, maxRetries=2,
+                retryBudget=0.1, hedge=False, hedgeDelay=0.05,
+                hedgePercentile=None, hedgeRatio=0.05, compress=False,
+                compressLevel=6, compressThreshold=1024,
+                slowRequestThreshold=None, *args, **kwargs):
         if not servers:
             servers = [DEFAULT_SERVER]
         elif isinstance(servers, (str, unicode)):
             servers = [servers]
-        self.servers = utils.ServerList(servers, retryTime=retryTime)
-        self.agents = {}
+        self.servers = utils.ServerList(servers, retryTime=retryTime,
+                                        balancer=balancer, probe=self.probe)
+        self.timeout = timeout
+        self.maxRetries = maxRetries
+        self.retryBudget = utils.Budget(retryBudget)
+        self.retried = 0
+        self.hedge = hedge
+        self.hedgeDelay = hedgeDelay
+        self.hedgePercentile = hedgePercentile
+        self.hedgeBudget = utils.Budget(hedgeRatio, reserve=1)
+        self.hedged = 0
+        self.latencies = utils.LatencyWindow()
+        self.pool = HTTPConnectionPool(reactor, persistent=persistent)
+        self.pool.maxPersistentPerHost = maxIdlePerServer
+        self.pool.cachedConnectionTimeout = idleTimeout
+        self.maxOpenPerServer = maxOpenPerServer
+        self.codec = jsoncodec.ThreadedCodec(jsoncodec.getCodec(codec),
+                                             threshold=offloadThreshold,
+                                             maxThreads=offloadThreads)
+        self.compress = compress
+        self.compressLevel = compressLevel
+        self.compressThreshold = compressThreshold
+        self.compression = {"compressedRequests": 0,
+                            "requestBytes": 0,
+                            "compressedRequestBytes": 0,
+                            "compressedResponses": 0,
+                            "responseBytes": 0,
+                            "compressedResponseBytes": 0}
+        self.semaphores = {}
+        self.pending = set()
+        self.drainWaiters = []
+        self.beforeRequest = []
+        self.afterRequest = []
+        self.slowRequestThreshold = slowRequestThreshold
+        self.slowRequests = collections.deque(maxlen=100)
+        self.metrics = metrics.Metrics()
+        self.metrics.addGauge("inFlight", lambda: len(self.pending))
+        self.metrics.addGauge("serverInFlight",
+                              lambda: dict(self.servers.balancer.inFlight))
+        self.metrics.addGauge("liveServers", lambda: len(self.servers))
+        self.metrics.addGauge("deadServers", lambda: len(self.servers.dead))
+        self.metrics.addGauge("retried", lambda: self.retried)
+        self.metrics.addGauge("hedged", lambda: self.hedged)
+        self.metrics.addGauge("pool", self.poolStats)
+        self.metrics.addGauge("codec", self.codecStats)
+        self.metrics.addGauge("compression", self.compressionStats)
 
     def close(self):
-        pass
+        """
+        Wait for the in-flight requests to finish then close all of the
+        cached connections in the pool and stop the codec threads
+        """
+        def closePool(_):
+            self.codec.stop()
+            return self.pool.closeCachedConnections()
+
+        self.servers.stop()
+        self.metrics.stop()
+        d = defer.Deferred()
+        d.addCallback(closePool)
+        if self.pending:
+            self.drainWaiters.append(d)
+        else:
+            d.callback(None)
+        return d
+
+    def probe(self, server, path="/"):
+        """
+        Send a GET for path to server alone, whatever the state of its
+        circuit breaker. Used to check that a server answers before it
+        gets traffic again.
+        """
+        def checkTimeout(result):
+            if call.active():
+                call.cancel()
+            return result
+
+        url = server + path
+        if not url.startswith("http://"):
+            url = "http://" + url
+        d = self._request("GET", str(url), None)
+        call = reactor.callLater(self.timeout or PROBE_TIMEOUT, d.cancel)
+        d.addBoth(checkTimeout)
+        return d
 
-    def execute(self, method, path, body=None, params=None):
+    def addRequestHooks(self, before=None, after=None):
+        """
+        Call before with the tracing.Trace of every request when it is
+        executed and after with it once the request has completed
+        """
+        if before is not None:
+            self.beforeRequest.append(before)
+        if after is not None:
+            self.afterRequest.append(after)
+
+    def removeRequestHooks(self, before=None, after=None):
+        if before in self.beforeRequest:
+            self.beforeRequest.remove(before)
+        if after in self.afterRequest:
+            self.afterRequest.remove(after)
+
+    def _callHooks(self, hooks, trace):
+        for hook in hooks:
+            try:
+                hook(trace)
+            except Exception:
+                log.err(None, "Request hook failed")
+
+    def poolStats(self):
+        """
+        Return connection reuse counters along with the idle and open
+        connection counts for every server
+        """
+        stats = self.pool.stats()
+        stats["open"] = dict((server, semaphore.limit - semaphore.tokens)
+                             for server, semaphore
+                             in self.semaphores.iteritems())
+        return stats
+
+    def codecStats(self):
+        """
+        Return how many payloads were encoded and decoded inline and how
+        many were offloaded to the thread pool
+        """
+        return dict(self.codec.stats)
+
+    def compressionStats(self):
+        """
+        Return the byte counts of the compressed requests and responses
+        along with the number of bytes compression kept off the wire
+        """
+        stats = dict(self.compression)
+        stats["bytesSaved"] = (stats["requestBytes"] -
+                               stats["compressedRequestBytes"] +
+                               stats["responseBytes"] -
+                               stats["compressedResponseBytes"])
+        return stats
+
+    def _compress(self, producer):
+        """
+        Return a producer sending the body of producer compressed when
+        compression is on and the body is at least compressThreshold bytes
+        """
+        if not self.compress:
+            return producer
+        if (producer.length != iweb.UNKNOWN_LENGTH and
+                producer.length < self.compressThreshold):
+            return producer
+
+        self.compression["compressedRequests"] += 1
+        if isinstance(producer, StringProducer):
+            body = gzipBody(producer.body, self.compressLevel)
+            self.compression["requestBytes"] += producer.length
+            self.compression["compressedRequestBytes"] += len(body)
+            return StringProducer(body, contentEncoding="gzip")
+        return GzipProducer(producer, self.compressLevel, self.compression)
+
+    def _getSemaphore(self, server):
+        if server not in self.semaphores:
+            self.semaphores[server] = defer.DeferredSemaphore(
+                self.maxOpenPerServer)
+        return self.semaphores[server]
+
+    def _request(self, method, url, body, hitCallback=None, span=None):
         def raiseExceptions(body, response):
             status = int(response.code)
             if status != 200:
                 exceptions.raiseExceptions(status, body)
             return body
 
+        def received(result, receiver):
+            self.metrics.increment("bytesReceived", receiver.received)
+            return result
+
         def parseResponse(response):
-            d = defer.Deferred()
-            response.deliverBody(JSONReceiver(d))
+            if span is not None:
+                span.mark("wait")
+            d = defer.Deferred(lambda _: receiver.transport.stopProducing())
+            receiver = JSONReceiver(d, self.codec, hitCallback, span)
+            response.deliverBody(receiver)
+            d.addBoth(received, receiver)
             return d.addCallback(raiseExceptions, response)
 
-        agent = self.getAgent()
-        server = self.servers.get()
+        headers = None
+        if getattr(body, "contentEncoding", None):
+            headers = http_headers.Headers({"Content-Encoding":
+                                            [body.contentEncoding]})
+        if span is not None:
+            span.mark("queue")
+        self.pool.span = span
+        try:
+            d = self.getAgent().request(method, url, headers=headers,
+                                        bodyProducer=body)
+        finally:
+            self.pool.span = None
+        d.addCallback(parseResponse)
+        return d
+
+    def execute(self, method, path, body=None, params=None,
+                hitCallback=None, timeout=None, hedge=None):
+        """
+        Send a request and fire with its decoded response.
+
+        timeout, or the timeout of the connection when it is None, limits
+        the whole call, retries and hedges included.
+        """
+        def done(result, d):
+            self.metrics.record(endpoint, time.time() - started,
+                                isinstance(result, failure.Failure))
+            if trace is not None:
+                self._traced(trace, result)
+            self.pending.discard(d)
+            if not self.pending:
+                waiters, self.drainWaiters = self.drainWaiters, []
+                for waiter in waiters:
+                    waiter.callback(None)
+            return result
+
+        def measure(producer):
+            if producer.length != iweb.UNKNOWN_LENGTH:
+                self.metrics.increment("bytesSent", producer.length)
+                if trace is not None:
+                    trace.requestBytes = producer.length
+            if trace is not None:
+                trace.encoded = time.time()
+            return producer
+
+        def send(producer):
+            if (hedge and method in READ_METHODS and not hitCallback and
+                    not path.startswith(SCROLL_PATH)):
+                return self._executeHedged(method, path, producer,
+                                           deadline, trace)
+            return self._execute(method, path, producer, hitCallback,
+                                 deadline, [], trace)
+
+        if hedge is None:
+            hedge = self.hedge
+        if timeout is None:
+            timeout = self.timeout
+        self.retryBudget.request()
+        started = time.time()
+        deadline = None
+        if timeout:
+            deadline = started + timeout
+        endpoint = metrics.endpointName(method, path)
+        self.metrics.increment("requests")
+
         if not path.startswith('/'):
             path = '/' + path
-        url = server + path
 
         if params:
-            url = url + '?' + urllib.urlencode(params)
+            path = path + '?' + urllib.urlencode(params)
+
+        trace = None
+        if (self.beforeRequest or self.afterRequest or
+                self.slowRequestThreshold is not None):
+            trace = tracing.Trace(method, path)
+            self._callHooks(self.beforeRequest, trace)
 
-        if isinstance(body, basestring):
-            body = StringProducer(body)
+        if iweb.IBodyProducer.providedBy(body):
+            d = defer.succeed(body)
+        elif isinstance(body, basestring):
+            d = defer.succeed(StringProducer(body))
         else:
-            body = JSONProducer(body)
+            d = self.codec.encodeLater(body)
+            d.addCallback(StringProducer)
+        d.addCallback(measure)
+        d.addCallback(self._compress)
+        d.addCallback(send)
+
+        self.pending.add(d)
+        d.addBoth(done, d)
+        return d
+
+    def _traced(self, trace, result):
+        """
+        Finish trace, log it if the request was slow and call the after
+        request hooks with it
+        """
+        trace.finished = time.time()
+        if isinstance(result, failure.Failure):
+            trace.error = result
+        threshold = self.slowRequestThreshold
+        if threshold is not None and trace.duration >= threshold:
+            self.slowRequests.append(trace)
+            log.msg("Slow request: %s" % trace)
+        self._callHooks(self.afterRequest, trace)
+
+    def _execute(self, method, path, producer, hitCallback, deadline,
+                 tried, trace=None, cancelled=None):
+        """
+        Send the request to a server, moving on to another one when a
+        transport failure makes it safe to try again. Each attempt gets
+        the time left until deadline and none is made once it has passed.
+
+        A request given a cancelled list which is no longer empty was
+        cancelled on purpose and is not sent again.
+        """
+        def retry(reason):
+            if cancelled:
+                return reason
+            if deadline is not None and time.time() >= deadline:
+                return reason
+            if not self._canRetry(method, path, reason, hitCallback,
+                                  tried):
+                return reason
+            self.retried += 1
+            return self._execute(method, path, producer, hitCallback,
+                                 deadline, tried, trace, cancelled)
+
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0.001)
+        server = self.servers.get(exclude=tried)
+        tried.append(server)
+        d = self._send(server, method, path, producer, hitCallback, timeout,
+                       trace, cancelled)
+        d.addErrback(retry)
+        return d
+
+    def _executeHedged(self, method, path, producer, deadline, trace=None):
+        """
+        Send a read and, if it has not been answered within the hedge
+        delay, send a duplicate to another server. The first response wins
+        and the other request is cancelled.
+        """
+        def cancelAll():
+            if call.active():
+                call.cancel()
+            for attempt, cancelled in list(attempts):
+                cancelled.append(True)
+                attempt.cancel()
+
+        def succeeded(response, entry):
+            attempts.remove(entry)
+            if decided or result.called:
+                return
+            decided.append(True)
+            cancelAll()
+            result.callback(response)
+
+        def failed(reason, entry):
+            attempts.remove(entry)
+            if decided or result.called or attempts:
+                return
+            decided.append(True)
+            if call.active():
+                call.cancel()
+            result.errback(reason)
 
+        def start():
+            cancelled = []
+            attempt = self._execute(method, path, producer, None, deadline,
+                                    tried, trace, cancelled)
+            entry = (attempt, cancelled)
+            attempts.append(entry)
+            attempt.addCallbacks(succeeded, failed, callbackArgs=(entry,),
+                                 errbackArgs=(entry,))
+
+        def hedge():
+            if attempts and self.hedgeBudget.withdraw():
+                self.hedged += 1
+                start()
+
+        attempts = []
+        tried = []
+        decided = []
+        result = defer.Deferred(lambda _: cancelAll())
+        self.hedgeBudget.request()
+        call = reactor.callLater(self._hedgeDelay(), hedge)
+        start()
+        return result
+
+    def _hedgeDelay(self):
+        if self.hedgePercentile:
+            delay = self.latencies.percentile(self.hedgePercentile)
+            if delay is not None:
+                return delay
+        return self.hedgeDelay
+
+    def _canRetry(self, method, path, reason, hitCallback, tried):
+        if len(tried) > self.maxRetries:
+            return False
+        if reason.check(*CONNECT_ERRORS):
+            pass
+        elif not reason.check(*TRANSPORT_ERRORS):
+            return False
+        elif method not in IDEMPOTENT_METHODS or hitCallback:
+            return False
+        elif path.startswith(SCROLL_PATH):
+            # The server may have moved the cursor before failing
+            return False
+        return self.retryBudget.withdraw()
+
+    def _send(self, server, method, path, producer, hitCallback, timeout,
+              trace=None, cancelled=None):
+        def healthy(result):
+            if span is not None:
+                trace.span = span
+            self.servers.markOk(server)
+            if method in READ_METHODS:
+                self.latencies.add(time.time() - started)
+            return result
+
+        def unhealthy(reason):
+            if cancelled:
+                return reason
+            if reason.check(*CONNECT_ERRORS):
+                self.servers.markDead(server)
+            elif reason.check(*TRANSPORT_ERRORS):
+                self.servers.markFailed(server)
+            return reason
+
+        def finished(result):
+            # Client errors such as a missing document are answers, only
+            # server errors and transport failures count as failed
+            failed = False
+            elapsed = time.time() - started
+            if isinstance(result, failure.Failure):
+                exc = result.value
+                failed = (not isinstance(exc,
+                                         exceptions.ElasticSearchException)
+                          or (exc.status or 500) >= 500)
+                if cancelled or result.check(defer.CancelledError):
+                    elapsed = None
+            self.servers.finished(server, elapsed, failed)
+            return result
+
+        def timedOut():
+            expired.append(True)
+            d.cancel()
+
+        def checkTimeout(result):
+            if call.active():
+                call.cancel()
+            if expired and isinstance(result, failure.Failure):
+                raise exceptions.RequestTimeout(
+                    "%s %s timed out after %ss" % (method, path, timeout),
+                    server)
+            return result
+
+        url = server + path
         if not url.startswith("http://"):
             url = "http://" + url
 
-        d = agent.request(method, str(url), bodyProducer=body)
-        d.addCallback(parseResponse)
+        span = None
+        if trace is not None:
+            span = trace.startSpan(server)
+        started = time.time()
+        self.servers.started(server)
+        if self.maxOpenPerServer:
+            semaphore = self._getSemaphore(server)
+            d = semaphore.run(self._request, method, str(url), producer,
+                              hitCallback, span)
+        else:
+            d = self._request(method, str(url), producer, hitCallback, span)
+
+        if timeout is None:
+            timeout = self.timeout
+        if timeout:
+            expired = []
+            call = reactor.callLater(timeout, timedOut)
+            d.addBoth(checkTimeout)
+
+        d.addCallbacks(healthy, unhealthy)
+        d.addBoth(finished)
         return d
@@ -1,8 +1,11 @@
-import anyjson
+import time
+import urllib
 
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, task
+from twisted.python import failure, log
 
-from txes import connection, exceptions
+from txes import batch, bulk, cache, connection, connection_http
+from txes import exceptions, jsoncodec, scroll, utils
 
 
 class ElasticSearch(object):
@@ -13,7 +16,18 @@ class ElasticSearch(object):
     """
     def __init__(self, servers=None, timeout=None, bulkSize=400,
                  discover=True, retryTime=10, discoveryInterval=300,
-                 defaultIndexes=None, autorefresh=False):
+                 defaultIndexes=None, autorefresh=False, persistent=True,
+                 maxIdlePerServer=2, maxOpenPerServer=None, idleTimeout=240,
+                 bulkChunkSize=65536, maxBulkBytes=None, maxBulkLatency=None,
+                 bulkRetries=3, bulkRetryDelay=0.1, bulkConcurrency=None,
+                 codec=None, offloadThreshold=None, offloadThreads=4,
+                 balancer=None, maxRetries=2, retryBudget=0.1, hedge=False,
+                 hedgeDelay=0.05, hedgePercentile=None, hedgeRatio=0.05,
+                 sniffFailures=2, minSniffInterval=1, cacheTTL=None,
+                 cacheSize=1000, coalesce=False, mgetWindow=None,
+                 mgetSize=100, msearchWindow=None, msearchSize=50,
+                 compress=False, compressLevel=6, compressThreshold=1024,
+                 slowRequestThreshold=None, bulkErrorCallback=None):
         if isinstance(servers, basestring):
             servers = [servers]
         else:
@@ -25,20 +39,77 @@ class ElasticSearch(object):
             defaultIndexes = [defaultIndexes]
 
         self.defaultIndexes = defaultIndexes
+        self.codec = jsoncodec.getCodec(codec)
         self.timeout = timeout
         self.bulkSize = bulkSize
+        self.bulkChunkSize = bulkChunkSize
+        self.maxBulkBytes = maxBulkBytes
+        self.maxBulkLatency = maxBulkLatency
+        self.bulkRetries = bulkRetries
+        self.bulkRetryDelay = bulkRetryDelay
+        self.bulkSemaphore = None
+        if bulkConcurrency:
+            self.bulkSemaphore = defer.DeferredSemaphore(bulkConcurrency)
         self.retryTime = retryTime
         self.discoveryInterval = discoveryInterval
+        self.sniffFailures = sniffFailures
+        self.minSniffInterval = minSniffInterval
         self.autorefresh = autorefresh
-        self.refreshed = True
+        self.writes = 0
+        self.dirty = {}
+        self.refreshing = {}
+        self.coalesce = coalesce
+        self.singleFlight = utils.SingleFlight()
+        self.cache = None
+        if cacheTTL:
+            self.cache = cache.MetadataCache(cacheTTL, cacheSize)
+        self.mgetBatcher = None
+        if mgetWindow is not None:
+            self.mgetBatcher = batch.Batcher(self._sendMget, mgetWindow,
+                                             mgetSize)
+        self.msearchBatcher = None
+        if msearchWindow is not None:
+            self.msearchBatcher = batch.Batcher(self._sendMsearch,
+                                                msearchWindow, msearchSize)
 
         self.info = {}
         self.bulkData = []
-
-        self.connection = connection.connect(servers=servers,
-                                             timeout=timeout,
-                                             retryTime=retryTime)
+        self.bulkBytes = 0
+        self.bulkCall = None
+        self.bulkInFlight = set()
+        self.bulkErrorCallback = bulkErrorCallback
+        self.discoveryCall = None
+        self.discovering = False
+        self.lastDiscovery = 0
+        self.closed = False
+
+        self.connection = connection.connect(
+            servers=servers, timeout=timeout, retryTime=retryTime,
+            persistent=persistent, maxIdlePerServer=maxIdlePerServer,
+            maxOpenPerServer=maxOpenPerServer, idleTimeout=idleTimeout,
+            codec=self.codec, offloadThreshold=offloadThreshold,
+            offloadThreads=offloadThreads, balancer=balancer,
+            maxRetries=maxRetries, retryBudget=retryBudget, hedge=hedge,
+            hedgeDelay=hedgeDelay, hedgePercentile=hedgePercentile,
+            hedgeRatio=hedgeRatio, compress=compress,
+            compressLevel=compressLevel, compressThreshold=compressThreshold,
+            slowRequestThreshold=slowRequestThreshold)
+        self.seeds = list(self.servers)
+        self.metrics = self.connection.metrics
+        self.metrics.addGauge("bulkQueueLength", lambda: len(self.bulkData))
+        self.metrics.addGauge("bulkQueueBytes", lambda: self.bulkBytes)
+        self.metrics.addGauge("bulkInFlight", lambda: len(self.bulkInFlight))
+        self.metrics.addGauge("coalesced", lambda: self.singleFlight.shared)
+        self.metrics.addGauge("cache", self.cacheStats)
+        if self.mgetBatcher is not None:
+            self.metrics.addGauge("mgetQueueLength",
+                                  lambda: len(self.mgetBatcher))
+        if self.msearchBatcher is not None:
+            self.metrics.addGauge("msearchQueueLength",
+                                  lambda: len(self.msearchBatcher))
         if discover:
+            if sniffFailures:
+                self.servers.addStateListener(self._serverStateChanged)
             self._performDiscovery()
         else:
             def cb(data):
@@ -50,23 +121,83 @@ class ElasticSearch(object):
         return '/' + '/'.join([str(c) for c in components if c])
 
     def _performDiscovery(self):
+        """
+        Replace the servers with the http addresses of the cluster nodes.
+        Requests in flight to nodes that left the cluster are left to
+        finish.
+        """
         def cb(data):
             self.cluster_name = data["cluster_name"]
+            servers = []
             for node in data["nodes"]:
                 httpAddr = data["nodes"][node].get("http_address")
                 if not httpAddr:
                     continue
 
-                server = httpAddr.strip("inet[/]")
-                self.connection.addServer(server)
-            reactor.callLater(self.discoveryInterval,
-                              self._performDiscovery)
+                servers.append(httpAddr.strip("inet[/]"))
+            if servers:
+                self.connection.setServers(servers)
+
+        def schedule(_):
+            self.discovering = False
+            if self.closed:
+                return
+            self.discoveryCall = reactor.callLater(self.discoveryInterval,
+                                                   self._performDiscovery)
+
+        if self.discoveryCall and self.discoveryCall.active():
+            self.discoveryCall.cancel()
+        self.discoveryCall = None
+        self.lastDiscovery = time.time()
+        self.discovering = True
 
-        d = self.clusterNodes()
+        if len(self.servers):
+            d = self.clusterNodes()
+        else:
+            d = self._discoverFromSeeds(list(self.seeds))
         d.addCallback(cb)
+        d.addErrback(log.err)
+        d.addCallback(schedule)
+        return d
+
+    def _discoverFromSeeds(self, seeds):
+        """
+        Ask the seed servers for the cluster nodes one after the other,
+        for when none of the known servers is taking traffic
+        """
+        def tryNext(failure):
+            if not seeds:
+                return failure
+            return self._discoverFromSeeds(seeds)
+
+        d = self.connection.probe(seeds.pop(0), "/_cluster/nodes")
+        d.addErrback(tryNext)
+        return d
+
+    def _serverStateChanged(self, server, oldState, newState):
+        """
+        Discover the cluster again as soon as sniffFailures servers are
+        down, at most once every minSniffInterval seconds
+        """
+        if newState != utils.CircuitBreaker.OPEN:
+            return
+        if len(self.servers.dead) < self.sniffFailures:
+            return
+        if self.discovering or self.closed:
+            return
+        if time.time() - self.lastDiscovery < self.minSniffInterval:
+            return
+        self._performDiscovery()
 
     def _sendQuery(self, queryType, query, indexes=None, docTypes=None,
-                   **params):
+                   hitCallback=None, requestTimeout=None, hedge=None,
+                   coalesce=None, **params):
+        """
+        Send a _search or _count query.
+
+        When the client batches searches, the queries without params or
+        any of the other options are sent together in a single _msearch.
+        """
         def sendIt(_):
             indices = self._validateIndexes(indexes)
             dt = docTypes
@@ -74,21 +205,214 @@ class ElasticSearch(object):
                 dt = []
             elif isinstance(dt, basestring):
                 dt = [dt]
+            if (self.msearchBatcher is not None and not params and
+                    hitCallback is None and requestTimeout is None and
+                    hedge is None and coalesce is None):
+                return self.msearchBatcher.add((queryType, indices, dt,
+                                                query))
             path = self._makePath([','.join(indices), ','.join(dt),
                                    queryType])
-            d = self._sendRequest("GET", path, body=query, params=params)
+            d = self._sendRequest("GET", path, body=query, params=params,
+                                  hitCallback=hitCallback,
+                                  timeout=requestTimeout, hedge=hedge,
+                                  coalesce=coalesce)
             return d
 
-        if self.autorefresh and not self.refreshed:
-            d = self.refresh(indexes)
+        if self.autorefresh and self.dirty:
+            d = self._refreshDirty(indexes)
             d.addCallback(sendIt)
             return d
         else:
-            return sendIt()
+            return sendIt(None)
+
+    def _sendMsearch(self, queries):
+        """
+        Send queries in a single _msearch and return the response or the
+        exception for each of them.
+
+        Counts are sent as searches with the count search type.
+        """
+        def factor(result):
+            results = []
+            for query, response in zip(queries, result["responses"]):
+                if "error" in response:
+                    status = response.get("status", 500)
+                    response = exceptions.convertException(status, response)
+                elif query[0] == "_count":
+                    response = {"count": response["hits"]["total"],
+                                "_shards": response.get("_shards")}
+                results.append(response)
+            return results
+
+        def single(result):
+            return [result]
+
+        if len(queries) == 1:
+            queryType, indices, docTypes, query = queries[0]
+            d = self._sendQuery(queryType, query, indices, docTypes,
+                                coalesce=self.coalesce)
+            d.addCallback(single)
+            return d
+
+        lines = []
+        for queryType, indices, docTypes, query in queries:
+            header = {"index": ','.join(indices)}
+            if docTypes:
+                header["type"] = ','.join(docTypes)
+            if queryType == "_count":
+                header["search_type"] = "count"
+                if isinstance(query, dict) and query.keys() != ["query"]:
+                    query = {"query": query}
+            if not isinstance(query, basestring):
+                query = self.codec.encode(query)
+            lines.append(self.codec.encode(header))
+            lines.append(query)
+        lines.append("")
+
+        d = self._sendRequest("GET", "/_msearch", body='\n'.join(lines))
+        d.addCallback(factor)
+        return d
+
+    def _sendRequest(self, method, path, body=None, params=None,
+                     coalesce=None, **kwargs):
+        """
+        Send a request through the connection.
+
+        With coalesce, or the coalesce default of the client when it is
+        None, a read sent while an identical one is in flight shares its
+        response instead of going to the cluster again.
+        """
+        kwargs = dict((k, v) for k, v in kwargs.iteritems() if v is not None)
+        if coalesce is None:
+            coalesce = self.coalesce
+        if (coalesce and method in connection_http.READ_METHODS and
+                not kwargs.get("hitCallback")):
+            if body is not None and not isinstance(body, basestring):
+                body = self.codec.encode(body)
+            query = urllib.urlencode(sorted((params or {}).items()))
+            key = (method, str(path), query, body)
+            return self.singleFlight.call(key, self.connection.execute,
+                                          method, str(path), body, params,
+                                          **kwargs)
 
-    def _sendRequest(self, method, path, body=None, params=None):
         d = defer.maybeDeferred(self.connection.execute,
-                                method, str(path), body, params)
+                                method, str(path), body, params, **kwargs)
+        return d
+
+    def _cached(self, endpoint, path, names, request, tags=None):
+        if self.cache is None:
+            return request()
+        return self.cache.fetch(endpoint, path, names, request, tags)
+
+    def _invalidate(self, names, d):
+        """
+        Drop the cached metadata for names now and once d has fired
+        """
+        def invalidate(result):
+            self.cache.invalidate(names)
+            return result
+
+        if self.cache is None:
+            return d
+        self.cache.invalidate(names)
+        return d.addBoth(invalidate)
+
+    @property
+    def refreshed(self):
+        return not self.dirty
+
+    def _markDirty(self, indexes):
+        """
+        Record a write to indexes, it becomes searchable once they have
+        been refreshed
+        """
+        self.writes += 1
+        for index in self._validateIndexes(indexes):
+            self.dirty[index] = self.writes
+
+    def _dirtyMarks(self, indexes=None):
+        """
+        Return the dirty indexes among indexes, all of them for _all or a
+        wildcard, along with their last write
+        """
+        indices = self._validateIndexes(indexes)
+        if cache.isBroad(indices):
+            return dict(self.dirty)
+        return dict((index, self.dirty[index]) for index in indices
+                    if index in self.dirty)
+
+    def _markClean(self, marks):
+        """
+        Forget the dirty indexes in marks unless written to since
+        """
+        for index, mark in marks.iteritems():
+            if self.dirty.get(index) == mark:
+                del self.dirty[index]
+
+    def _refreshDirty(self, indexes=None):
+        """
+        Refresh the dirty indexes a query on indexes would search.
+
+        Writes are tracked under the names they were made to, so when the
+        query names an index or alias that is not dirty while others are,
+        it may still cover their writes through an alias. The query names
+        are then refreshed along with every dirty index.
+
+        An index already being refreshed since its last write is not
+        refreshed again, the query waits for that refresh instead.
+        """
+        def done(result, marks, waiters):
+            for index in marks:
+                if self.refreshing.get(index, (None, None))[1] is waiters:
+                    del self.refreshing[index]
+            if not isinstance(result, failure.Failure):
+                self._markClean(marks)
+            for waiter in waiters:
+                if isinstance(result, failure.Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+
+        def refreshIt(_, marks, waiters):
+            path = self._makePath([','.join(sorted(marks)), "_refresh"])
+            d = self._sendRequest("POST", path)
+            d.addBoth(done, marks, waiters)
+
+        dirty = self._dirtyMarks(indexes)
+        if self.dirty:
+            indices = self._validateIndexes(indexes)
+            unknown = [index for index in indices if index not in dirty]
+            if unknown and not cache.isBroad(indices):
+                dirty = dict(self.dirty)
+                for index in unknown:
+                    dirty[index] = self.writes
+
+        ds = []
+        marks = {}
+        for index, mark in dirty.iteritems():
+            inFlight = self.refreshing.get(index)
+            if inFlight and inFlight[0] >= mark:
+                waiter = defer.Deferred()
+                inFlight[1].append(waiter)
+                ds.append(waiter)
+            else:
+                marks[index] = mark
+
+        if marks:
+            waiter = defer.Deferred()
+            waiters = [waiter]
+            for index, mark in marks.iteritems():
+                self.refreshing[index] = (mark, waiters)
+            ds.append(waiter)
+            if self.bulkData or self.bulkInFlight:
+                d = self.forceBulk()
+            else:
+                d = defer.succeed(None)
+            d.addCallback(refreshIt, marks, waiters)
+            d.addErrback(done, marks, waiters)
+
+        d = defer.gatherResults(ds, consumeErrors=True)
+        d.addErrback(lambda reason: reason.value.subFailure)
         return d
 
     def _validateIndexes(self, indexes=None):
@@ -103,7 +427,9 @@ class ElasticSearch(object):
         """
         indices = self._validateIndexes(indexes)
         path = self._makePath([','.join(indices), "_status"])
-        d = self._sendRequest("GET", path)
+        d = self._cached("status", path, indices,
+                         lambda: self._sendRequest("GET", path),
+                         lambda result: result.get("indices", {}).keys())
         return d
 
     def createIndex(self, index, settings=None):
@@ -111,7 +437,7 @@ class ElasticSearch(object):
         Creates and index with the optional settings dict.
         """
         d = self._sendRequest("PUT", index, settings)
-        return d
+        return self._invalidate([index], d)
 
     def createIndexIfMissing(self, index, settings=None):
         def eb(failure):
@@ -126,7 +452,7 @@ class ElasticSearch(object):
         Deletes and index.
         """
         d = self._sendRequest("DELETE", index)
-        return d
+        return self._invalidate([index], d)
 
     def deleteIndexIfExists(self, index):
         def eb(failure):
@@ -196,8 +522,11 @@ class ElasticSearch(object):
         You may specify multiple commands as additional arguments
         """
         actions = [{c: {"index": i, "alias": a}} for c, i, a in commands]
+        names = set()
+        for command, index, alias in commands:
+            names.update([index, alias])
         d = self._sendRequest("POST", "_aliases", {"actions": actions})
-        return d
+        return self._invalidate(names, d)
 
     def addAlias(self, alias, indices):
         """
@@ -260,20 +589,32 @@ class ElasticSearch(object):
             d = self._sendRequest("POST", path, params=params)
             return d
 
-        if self.bulkData:
+        if self.bulkData or self.bulkInFlight:
             d = self.forceBulk()
             d.addCallback(flushIt)
             return d
         else:
             return flushIt()
 
-    def refresh(self, indexes=None, timesleep=1):
+    def refresh(self, indexes=None, timesleep=None):
+        """
+        Refresh one or more indices so that their latest changes are
+        searchable.
+
+        Given timesleep the deferred only fires after sleeping that many
+        seconds and waiting for the cluster health to turn green.
+        """
         def wait(results):
             d = self.clusterHealth(waitForStatus="green")
             d.addCallback(lambda _: results)
-            self.refreshed = True
             return d
 
+        def clean(results):
+            self._markClean(marks)
+            if timesleep:
+                return delay(results)
+            return results
+
         def delay(results):
             d = defer.Deferred()
             reactor.callLater(timesleep, d.callback, results)
@@ -284,15 +625,16 @@ class ElasticSearch(object):
             indices= self._validateIndexes(indexes)
             path = self._makePath([','.join(indices), "_refresh"])
             d = self._sendRequest("POST", path)
-            d.addCallback(delay)
+            d.addCallback(clean)
             return d
 
-        if self.bulkData:
+        marks = self._dirtyMarks(indexes)
+        if self.bulkData or self.bulkInFlight:
             d = self.forceBulk()
             d.addCallback(refreshIt)
             return d
         else:
-            return refreshIt()
+            return refreshIt(None)
 
     def optimize(self, indexes=None, waitForMerge=False,
                  maxNumSegments=None, onlyExpungeDeletes=False,
@@ -301,17 +643,19 @@ class ElasticSearch(object):
         Optimize one or more indices.
         """
         def done(results):
-            self.refreshed = True
+            if refresh:
+                self._markClean(marks)
             return results
 
         indices = self._validateIndexes(indexes)
         path = self._makePath([','.join(indices), "_optimize"])
         params = {"wait_for_merge": waitForMerge,
                   "only_expunge_deletes": onlyExpungeDeletes,
-                  "refesh": refresh,
+                  "refresh": refresh,
                   "flush": flush}
         if maxNumSegments:
-            params["max_num_segments"] = maxNumSegement
+            params["max_num_segments"] = maxNumSegments
+        marks = self._dirtyMarks(indexes)
         d = self._sendRequest("POST", path, params=params)
         d.addCallback(done)
         return d
@@ -347,22 +691,19 @@ class ElasticSearch(object):
         path = self._makePath([','.join(indices), docType, "_mapping"])
         if docType not in mapping:
             mapping = {docType: mapping}
-        self.refreshed = False
+        self._markDirty(indices)
         d = self._sendRequest("PUT", path, body=mapping)
-        return d
+        return self._invalidate(indices, d)
 
     def getMapping(self, docType=None, indexes=None):
         """
         Get the mapping definition
         """
         indices = self._validateIndexes(indexes)
-        path = [','.join(indices)]
-
-        if docType:
-            path.append(docType)
-
-        path.append("_mapping")
-        d = self._sendRequest("GET", path)
+        path = self._makePath([','.join(indices), docType, "_mapping"])
+        d = self._cached("mapping", path, indices,
+                         lambda: self._sendRequest("GET", path),
+                         lambda result: result.keys())
         return d
 
     def collectInfo(self):
@@ -439,7 +780,10 @@ class ElasticSearch(object):
             else:
                 params['filter_indices'] = ','.join(filterIndices)
 
-        d = self._sendRequest("GET", path, params=params)
+        key = (path, tuple(sorted(params.items())))
+        d = self._cached("state", key, None,
+                         lambda: self._sendRequest("GET", path,
+                                                   params=params))
         return d
 
     def clusterNodes(self, nodes=None):
@@ -467,8 +811,13 @@ class ElasticSearch(object):
               querystringArgs=None):
         """
         Index a dict into a specific index and make it searchable
+
+        doc may also be a string holding an already encoded JSON document,
+        it is then sent as is. Bulk lines are separated by newlines, so a
+        string document spanning several lines is decoded and encoded
+        again on a single line before being queued.
         """
-        self.refreshed = False
+        self._markDirty(index)
 
         if bulk:
             optype = "index"
@@ -481,10 +830,14 @@ class ElasticSearch(object):
                 cmd[optype]["_version"] = version
             if id:
                 cmd[optype]["_id"] = id
-            data = '\n'.join([anyjson.serialize(cmd),
-                              anyjson.serialize(doc)])
-            self.bulkData.append(data)
-            return self.flushBulk()
+            if isinstance(doc, unicode):
+                doc = doc.encode("utf-8")
+            if not isinstance(doc, str):
+                doc = self.codec.encode(doc)
+            elif '\n' in doc:
+                doc = self.codec.encode(self.codec.decode(doc))
+            data = '\n'.join([self.codec.encode(cmd), doc])
+            return self._queueBulk(data)
 
         if not querystringArgs:
             querystringArgs = {}
@@ -508,36 +861,201 @@ class ElasticSearch(object):
                               params=querystringArgs)
         return d
 
+    def _queueBulk(self, data):
+        def timedOut():
+            self.bulkCall = None
+            self._startBulk()
+
+        self.bulkData.append(data)
+        self.bulkBytes += len(data) + 1
+        if self.maxBulkLatency and not self.bulkCall:
+            self.bulkCall = reactor.callLater(self.maxBulkLatency, timedOut)
+        return self.flushBulk()
+
     def flushBulk(self, forced=False):
         """
         Wait to process all pending operations
+
+        The bulk data is sent once it holds bulkSize operations or
+        maxBulkBytes bytes, whichever comes first. With bulkConcurrency
+        set the deferred fires as soon as the bulk request is on its way,
+        so that several of them can be in flight at once.
+        """
+        full = len(self.bulkData) >= self.bulkSize
+        if self.maxBulkBytes and self.bulkBytes >= self.maxBulkBytes:
+            full = True
+        if forced or (full and not self.bulkSemaphore):
+            return self.forceBulk()
+        if not full:
+            return self._waitForBulkCapacity()
+        return self._startBulk()
+
+    def _takeBulk(self):
+        if self.bulkCall and self.bulkCall.active():
+            self.bulkCall.cancel()
+        self.bulkCall = None
+
+        actions = self.bulkData
+        self.bulkData = []
+        self.bulkBytes = 0
+        return actions
+
+    def _startBulk(self):
+        """
+        Send the bulk data in the background once a bulk slot is free,
+        the deferred fires when the request has been started. Nobody
+        waits for the BulkResult, so the actions which failed for good
+        are handed to _reportBulkErrors.
         """
-        if not forced and len(self.bulkData) < self.bulkSize:
+        def sent(result):
+            self._reportBulkErrors(result["errors"])
+
+        def failed(reason):
+            log.err(reason, "Bulk request failed")
+            self._reportBulkErrors([(action, reason.value)
+                                    for action in actions])
+
+        def release(result):
+            if self.bulkSemaphore:
+                self.bulkSemaphore.release()
+            return result
+
+        def send(_):
+            d = self._sendBulk(actions, bulk.BulkResult())
+            d.addCallbacks(sent, failed)
+            d.addBoth(release)
+            d.addBoth(self._bulkFinished, done)
+
+        actions = self._takeBulk()
+        if not actions:
             return defer.succeed(None)
-        return self.forceBulk()
+        done = self._trackBulk()
+        if not self.bulkSemaphore:
+            send(None)
+            return defer.succeed(None)
+        d = self.bulkSemaphore.acquire()
+        d.addCallback(send)
+        return d
+
+    def _reportBulkErrors(self, errors):
+        """
+        Log every (action, exception) in errors and pass it on to the
+        bulkErrorCallback of the client
+        """
+        for action, exc in errors:
+            log.msg("Bulk action %s failed: %r" % (action.split('\n')[0],
+                                                   exc))
+            if self.bulkErrorCallback is None:
+                continue
+            try:
+                self.bulkErrorCallback(action, exc)
+            except Exception:
+                log.err(None, "Bulk error callback failed")
+
+    def _trackBulk(self):
+        """
+        Return a deferred standing for a batch taken out of bulkData, it is
+        waited for by forceBulk until passed to _bulkFinished
+        """
+        done = defer.Deferred()
+        self.bulkInFlight.add(done)
+        return done
+
+    def _bulkFinished(self, result, done):
+        self.bulkInFlight.discard(done)
+        done.callback(None)
+        return result
+
+    def _waitForBulkCapacity(self):
+        def release(semaphore):
+            semaphore.release()
+
+        if not self.bulkSemaphore or self.bulkSemaphore.tokens:
+            return defer.succeed(None)
+        d = self.bulkSemaphore.acquire()
+        d.addCallback(release)
+        return d
 
     def forceBulk(self):
         """
         Force executing of all bulk data
+
+        Fires with a BulkResult. Operations the cluster rejected because it
+        was busy are sent again, up to bulkRetries times with exponential
+        backoff, the rest of the failures are reported in its errors.
+
+        With bulkConcurrency set, at most that many bulk requests are in
+        flight at once and the rest wait for one of them to finish. The
+        deferred also waits for the bulk requests already in flight.
+
+        The operations of bulk requests sent in the background, once
+        maxBulkLatency has elapsed or by a full queue under
+        bulkConcurrency, which failed for good are logged and handed to
+        bulkErrorCallback with their exception.
         """
-        if not len(self.bulkData):
-            return defer.succeed(None)
+        def wait(result):
+            d = defer.DeferredList(inFlight)
+            d.addCallback(lambda _: result)
+            return d
+
+        inFlight = list(self.bulkInFlight)
+        actions = self._takeBulk()
+        if not actions:
+            d = defer.succeed(None)
+        else:
+            done = self._trackBulk()
+            if self.bulkSemaphore:
+                d = self.bulkSemaphore.run(self._sendBulk, actions,
+                                           bulk.BulkResult())
+            else:
+                d = self._sendBulk(actions, bulk.BulkResult())
+            d.addBoth(self._bulkFinished, done)
+        if inFlight:
+            d.addBoth(wait)
+        return d
 
-        data = '\n'.join(self.bulkData)
+    def _sendBulk(self, actions, result, attempt=0):
+        def factor(response):
+            retry = []
+            errors = 0
+            for action, item in zip(actions, response.get("items", [])):
+                exc = bulk.itemException(item)
+                if exc is None:
+                    result["items"].append(item)
+                elif bulk.retryable(exc) and attempt < self.bulkRetries:
+                    retry.append(action)
+                else:
+                    result["errors"].append((action, exc))
+                    errors += 1
+            self.metrics.increment("bulkErrors", errors)
+
+            if not retry:
+                return result
+
+            self.metrics.increment("bulkRetried", len(retry))
+            result["retried"] += len(retry)
+            delay = self.bulkRetryDelay * 2 ** attempt
+            return task.deferLater(reactor, delay, self._sendBulk, retry,
+                                   result, attempt + 1)
+
+        self.metrics.increment("bulkRequests")
+        self.metrics.increment("bulkActions", len(actions))
+        data = connection_http.BulkProducer(actions,
+                                            chunkSize=self.bulkChunkSize)
         d = self._sendRequest("POST", "/_bulk", body=data)
-        self.bulkData = []
+        d.addCallback(factor)
         return d
 
     def delete(self, index, docType, id, bulk=False):
         """
         Delete a typed JSON document from a specific index based on its id.
         """
+        self._markDirty(index)
         if bulk:
             cmd = {"delete": {"_index": index,
                               "_type": docType,
                               "_id": id}}
-            self.bulkData.append(anyjson.serialize(cmd))
-            return self.flushBulk()
+            return self._queueBulk(self.codec.encode(cmd))
 
         path = self._makePath([index, docType, id])
         d = self._sendRequest("DELETE", path)
@@ -556,7 +1074,8 @@ class ElasticSearch(object):
 
         path = self._makePath([','.join(indices), ','.join(docTypes),
                                "_query"])
-        d = self._sendRequest("DELETE", path, body=body, params=params)
+        self._markDirty(indices)
+        d = self._sendRequest("DELETE", path, body=query, params=params)
         return d
 
     def deleteMapping(self, index, docType):
@@ -565,62 +1084,202 @@ class ElasticSearch(object):
         """
         path = self._makePath([index, docType])
         d = self._sendRequest("DELETE", path)
-        return d
+        return self._invalidate([index], d)
 
-    def get(self, index, docType, id, fields=None, routing=None, **params):
+    def get(self, index, docType, id, fields=None, routing=None,
+            requestTimeout=None, hedge=None, coalesce=None, **params):
         """
         Get a typed document form an index based on its id.
+
+        requestTimeout, hedge and coalesce override the defaults of the
+        client. When the client batches gets, the ones without any of
+        these or extra params are sent together in a single _mget.
         """
+        if (self.mgetBatcher is not None and not params and
+                requestTimeout is None and hedge is None and
+                coalesce is None):
+            doc = {"_index": index, "_type": docType, "_id": id}
+            if fields:
+                doc["fields"] = fields
+            if routing:
+                doc["_routing"] = routing
+            return self.mgetBatcher.add(doc)
+
         path = self._makePath([index, docType, id])
         if fields:
             params["fields"] = ','.join(fields)
         if routing:
-            params["routings"] = routing
-        d = self._sendRequest("GET", path, params=params)
+            params["routing"] = routing
+        d = self._sendRequest("GET", path, params=params,
+                              timeout=requestTimeout, hedge=hedge,
+                              coalesce=coalesce)
         return d
 
-    def search(self, query, indexes=None, docType=None, **params):
+    def _sendMget(self, docs):
+        """
+        Get docs in a single _mget and return the document or the
+        exception for each of them
+        """
+        def factor(result):
+            results = []
+            for doc in result["docs"]:
+                if "error" in doc:
+                    exc = exceptions.convertException(doc.get("status", 500),
+                                                      doc)
+                    results.append(exc)
+                elif not doc.get("found", doc.get("exists", True)):
+                    exc = exceptions.NotFoundException("Item not found", 404,
+                                                       doc)
+                    results.append(exc)
+                else:
+                    results.append(doc)
+            return results
+
+        def single(result):
+            return [result]
+
+        if len(docs) == 1:
+            doc = docs[0]
+            d = self.get(doc["_index"], doc["_type"], doc["_id"],
+                         fields=doc.get("fields"),
+                         routing=doc.get("_routing"), coalesce=self.coalesce)
+            d.addCallback(single)
+            return d
+
+        d = self._sendRequest("GET", "/_mget", body={"docs": docs})
+        d.addCallback(factor)
+        return d
+
+    def search(self, query, indexes=None, docType=None, hitCallback=None,
+               requestTimeout=None, hedge=None, coalesce=None, **params):
         """
         Execute a search agains one or more indices
+
+        If hitCallback is given each hit is handed to it as soon as it is
+        received and the result holds an empty hits list. requestTimeout,
+        hedge and coalesce override the defaults of the client.
         """
         indices = self._validateIndexes(indexes)
-        d = self._sendQuery("_search", query, indices, docType, **params)
+        d = self._sendQuery("_search", query, indices, docType,
+                            hitCallback=hitCallback,
+                            requestTimeout=requestTimeout, hedge=hedge,
+                            coalesce=coalesce, **params)
         return d
 
     def scan(self, query, indexes=None, docTypes=None, scrollTimeout="10m",
-             **params):
+             prefetch=1, hitCallback=None, searchType="scan", **params):
         """
         Return an iterator which will scan against one or more indices.
         Each call to next() will yeild a deferred that will contain the
-        next dataset
-        """
+        next dataset, or None once all of the hits have been returned.
 
-        class Scroller(object):
-            def __init__(self, results):
-                self.results = results
-
-            def __iter__(self):
-                return self
+        Up to prefetch pages are requested ahead of the consumer. If
+        hitCallback is given, it is called with every hit as it arrives.
+        """
+        def factor(results):
+            return scroll.Scroller(self, results, scrollTimeout=scrollTimeout,
+                                   prefetch=prefetch, hitCallback=hitCallback)
 
-            def _setResults(self, results):
-                if not len(results["hits"]["hits"]):
-                    raise StopIteration
-                self.results = results
-                return results
+        d = self.search(query=query, indexes=indexes, docType=docTypes,
+                        search_type=searchType, scroll=scrollTimeout,
+                        **params)
+        d.addCallback(factor)
+        return d
 
-            def next(self):
-                scrollId = self.results["_scroll_id"]
-                d = self._send_request("GET", "_search/scroll", scrollId,
-                                       {"scroll": scrollTimeout})
-                d.addCallback(self._setResults)
-                return
+    def parallelScan(self, query, indexes=None, docTypes=None, slices=4,
+                     sliceBy="index", partitionField=None,
+                     scrollTimeout="10m", prefetch=1, hitCallback=None,
+                     **params):
+        """
+        Scan with up to slices scroll cursors running concurrently and
+        merge their pages into a single iterator.
+
+        sliceBy selects how the work is split:
+
+         - index: the target indices are spread over the slices
+         - shard: the shard numbers of the target indices are spread over
+                  the slices through the preference parameter
+         - field: each slice only matches the documents whose numeric
+                  partitionField modulo slices equals the slice number
+
+        Fires with a MultiScroller which behaves like the iterator
+        returned by scan().
+        """
+        if sliceBy not in ("index", "shard", "field"):
+            raise ValueError("Invalid sliceBy: %s" % sliceBy)
+        if sliceBy == "field" and not partitionField:
+            raise ValueError("sliceBy field requires a partitionField")
+
+        def groups(units):
+            count = min(slices, len(units))
+            return [units[i::count] for i in range(count)]
+
+        def merge(results):
+            scrollers = [result for ok, result in results if ok]
+            failures = [result for ok, result in results if not ok]
+            if failures:
+                for scroller in scrollers:
+                    scroller.close()
+                return failures[0]
+            return scroll.MultiScroller(scrollers)
+
+        def scanSlices(slicesArgs):
+            ds = []
+            for sliceArgs in slicesArgs:
+                sliceParams = dict(params)
+                sliceParams.update(sliceArgs)
+                ds.append(self.scan(docTypes=docTypes,
+                                    scrollTimeout=scrollTimeout,
+                                    prefetch=prefetch,
+                                    hitCallback=hitCallback,
+                                    **sliceParams))
+            d = defer.DeferredList(ds, consumeErrors=True)
+            d.addCallback(merge)
+            return d
 
-        def scroll(results):
-            return Scroller(results)
+        def byIndex(status):
+            indices = sorted(status["indices"])
+            return scanSlices([{"query": query, "indexes": group}
+                               for group in groups(indices)])
+
+        def byShard(status):
+            count = max([len(info["shards"])
+                         for info in status["indices"].itervalues()] or [0])
+            return scanSlices([{"query": query, "indexes": indexes,
+                                "preference": "_shards:%s" %
+                                ','.join([str(s) for s in group])}
+                               for group in groups(range(count))])
+
+        def byField():
+            script = "doc[field].value % slices == slice"
+            slicesArgs = []
+            for i in range(slices):
+                sliceQuery = dict(query)
+                sliceQuery["query"] = {"filtered": {
+                    "query": query.get("query", {"match_all": {}}),
+                    "filter": {"script": {
+                        "script": script,
+                        "params": {"field": partitionField,
+                                   "slices": slices,
+                                   "slice": i}}}}}
+                slicesArgs.append({"query": sliceQuery, "indexes": indexes})
+            return scanSlices(slicesArgs)
+
+        if sliceBy == "field":
+            return byField()
+
+        d = self.status(indexes)
+        if sliceBy == "index":
+            d.addCallback(byIndex)
+        else:
+            d.addCallback(byShard)
+        return d
 
-        d = self.search(query=query, indexes=indexes, docTypes=docTypes,
-                        searchTypes="scan", scroll=scrollTimeout, **params)
-        d.addCallback(scroll)
+    def clearScroll(self, scrollId):
+        """
+        Release the server side context of a scroll search
+        """
+        d = self._sendRequest("DELETE", "/_search/scroll", body=scrollId)
         return d
 
     def reindex(self, query, indexes=None, docTypes=None, **params):
@@ -642,8 +1301,9 @@ class ElasticSearch(object):
         """
         Execute a query against one or more indices and get the hit count
         """
-        indices = self._balidateIndexes(indexes)
+        indices = self._validateIndexes(indexes)
         d = self._sendQuery("_count", query, indices, docTypes, **params)
+        return d
 
     def createRiver(self, river, riverName=None):
         """
@@ -681,6 +1341,97 @@ class ElasticSearch(object):
         d = self._sendRequest("PUT", path, body=settings)
         return d
 
+    def close(self):
+        """
+        Stop discovery, flush any pending bulk data and close all
+        connections to elasticsearch
+        """
+        def closeIt(_):
+            return self.connection.close()
+
+        self.closed = True
+        if self.discoveryCall and self.discoveryCall.active():
+            self.discoveryCall.cancel()
+        self.discoveryCall = None
+        if self.mgetBatcher is not None:
+            self.mgetBatcher.flush()
+        if self.msearchBatcher is not None:
+            self.msearchBatcher.flush()
+
+        d = self.forceBulk()
+        d.addBoth(closeIt)
+        return d
+
+    def poolStats(self):
+        """
+        Return the connection pool statistics
+        """
+        return self.connection.poolStats()
+
+    def codecStats(self):
+        """
+        Return the counters of inline and offloaded JSON work
+        """
+        return self.connection.codecStats()
+
+    def compressionStats(self):
+        """
+        Return the bytes sent and received compressed and how many bytes
+        compression saved
+        """
+        return self.connection.compressionStats()
+
+    def metricsSnapshot(self):
+        """
+        Return the request counters, per-endpoint latency histograms and
+        the current value of every gauge
+        """
+        return self.metrics.snapshot()
+
+    def addMetricsExporter(self, exporter, interval=10):
+        """
+        Call exporter with a metrics snapshot every interval seconds until
+        the client is closed
+        """
+        self.metrics.addExporter(exporter, interval)
+
+    def removeMetricsExporter(self, exporter):
+        self.metrics.removeExporter(exporter)
+
+    def addRequestHooks(self, before=None, after=None):
+        """
+        Call before with the trace of every request as it is sent and
+        after with it once it has completed. The trace holds the server,
+        the payload sizes and the time spent in each phase of the request.
+        """
+        self.connection.addRequestHooks(before, after)
+
+    def removeRequestHooks(self, before=None, after=None):
+        self.connection.removeRequestHooks(before, after)
+
+    @property
+    def slowRequests(self):
+        """
+        The traces of the last requests which took longer than
+        slowRequestThreshold seconds
+        """
+        return self.connection.slowRequests
+
+    def cacheStats(self):
+        """
+        Return the hit, miss and eviction counters of the metadata cache
+        """
+        if self.cache is None:
+            return {}
+        return self.cache.getStats()
+
+    def invalidateCache(self, indexes=None):
+        """
+        Drop the cached metadata of indexes, or all of it
+        """
+        if self.cache is not None:
+            self.cache.invalidate(self._validateIndexes(indexes))
+
     @property
     def servers(self):
         return self.connection.servers
@@ -5,6 +5,15 @@ class NoServerAvailable(Exception):
     pass
 
 
+class RequestTimeout(Exception):
+    """
+    Raised when a request did not complete within its timeout
+    """
+    def __init__(self, error, server=None):
+        super(RequestTimeout, self).__init__(error)
+        self.server = server
+
+
 class InvalidQuery(Exception):
     pass
 
@@ -75,39 +84,59 @@ class MapperParsingException(ElasticSearchException):
     pass
 
 
+class EsRejectedExecutionException(ElasticSearchException):
+    pass
+
+
+class VersionConflictEngineException(ElasticSearchException):
+    pass
+
+
 exception_patterns_trailing = {
     '] missing': NotFoundException,
     '] Already exists': AlreadyExistsException,
 }
 
 
-def raiseExceptions(status, result):
+def convertException(status, result):
     """
-    Raise an exception if the result is an error ( status > 400 )
+    Return the exception for an error result ( status > 400 ) or None
     """
     status = int(status)
 
     if status < 400:
-        return
+        return None
 
     if status == 404 and isinstance(result, dict):
-        raise NotFoundException("Item not found", status, result)
+        return NotFoundException("Item not found", status, result)
 
     if not isinstance(result, dict) or "error" not in result:
-        raise ElasticSearchException("Unknown exception type",
-                                     status, result)
+        return ElasticSearchException("Unknown exception type",
+                                      status, result)
 
     error = result["error"]
+    if not isinstance(error, basestring):
+        return ElasticSearchException(error, status, result)
+
     bits = error.split('[', 1)
     if len(bits) == 2:
         excClass = globals().get(bits[0])
         if excClass:
             msg = bits[1].rstrip(']')
-            raise excClass(msg, status, result)
+            return excClass(msg, status, result)
 
     for pattern, excClass in exception_patterns_trailing.iteritems():
         if not error.endswith(pattern):
             continue
-        raise excClass(error, status, result)
+        return excClass(error, status, result)
+
+    return ElasticSearchException(error, status, result)
+
 
-    raise ElasticSearchException(error, status, result)
+def raiseExceptions(status, result):
+    """
+    Raise an exception if the result is an error ( status > 400 )
+    """
+    exc = convertException(status, result)
+    if exc is not None:
+        raise exc
@@ -7,6 +7,12 @@ class IConnection(interface.Interface):
         Add a single server to the server pool
         """
 
+    def setServers(servers):
+        """
+        Replace the server pool with servers, keeping the state of the
+        servers already in it
+        """
+
     def connect(servers=None, timeout=None, retryTime=10,
                 *args, **kwargs):
         """
@@ -18,7 +24,12 @@ class IConnection(interface.Interface):
         close all connections to elasticsearch
         """
 
-    def execute(method, path, body=None, params=None):
+    def execute(method, path, body=None, params=None, hitCallback=None,
+                timeout=None, hedge=None):
         """
         Perform method on path with optional body
+
+        If hitCallback is given it is called with each search hit as it is
+        received instead of collecting them in the response. timeout and
+        hedge override the defaults given to connect
         """
@@ -0,0 +1,159 @@
+from twisted.internet import defer, reactor, threads
+from twisted.python import threadpool
+
+
+ENCODERS = ("ujson", "simplejson", "json")
+DECODERS = ("ujson", "simplejson", "json")
+
+
+def _load(name):
+    try:
+        module = __import__(name)
+    except ImportError:
+        return None
+    return module
+
+
+def _probe(names):
+    for name in names:
+        module = _load(name)
+        if module is not None:
+            return name, module
+
+
+class JSONCodec(object):
+    """
+    The encode and decode functions used for request and response bodies
+    """
+    def __init__(self, encode, decode, encoderName=None, decoderName=None):
+        self.encode = encode
+        self.decode = decode
+        self.encoderName = encoderName
+        self.decoderName = decoderName
+
+    def __repr__(self):
+        return "<JSONCodec encoder=%s decoder=%s>" % (self.encoderName,
+                                                      self.decoderName)
+
+
+def getCodec(codec=None):
+    """
+    Return a JSONCodec.
+
+    codec may be the name of a backend module, an object providing encode
+    and decode, or None to use the fastest backend installed for each
+    direction, falling back to the stdlib json module.
+    """
+    if codec is not None and not isinstance(codec, basestring):
+        return codec
+
+    if codec:
+        module = _load(codec)
+        if module is None:
+            raise ValueError("JSON backend %s is not available" % codec)
+        return JSONCodec(module.dumps, module.loads, codec, codec)
+
+    encoderName, encoder = _probe(ENCODERS)
+    decoderName, decoder = _probe(DECODERS)
+    return JSONCodec(encoder.dumps, decoder.loads, encoderName, decoderName)
+
+
+def estimateSize(obj, limit, depth=3):
+    """
+    Roughly guess the encoded size of obj, giving up once it reaches limit
+    """
+    size = 0
+    stack = [(obj, depth)]
+    while stack and size < limit:
+        obj, depth = stack.pop()
+        if isinstance(obj, basestring):
+            size += len(obj) + 2
+        elif isinstance(obj, dict):
+            size += len(obj) * 8
+            if depth:
+                stack.extend([(v, depth - 1) for v in obj.itervalues()])
+        elif isinstance(obj, (list, tuple)):
+            size += len(obj) * 2
+            if depth:
+                stack.extend([(v, depth - 1) for v in obj])
+        else:
+            size += 8
+    return size
+
+
+class ThreadedCodec(object):
+    """
+    Wrap a codec so payloads of at least threshold bytes are encoded and
+    decoded in a bounded thread pool instead of on the reactor thread.
+
+    With threshold None everything is done inline.
+    """
+    def __init__(self, codec, threshold=None, maxThreads=4):
+        self.codec = codec
+        self.encode = codec.encode
+        self.decode = codec.decode
+        self.threshold = threshold
+        self.maxThreads = maxThreads
+        self.pool = None
+        self.trigger = None
+        self.stats = {"inlineEncodes": 0,
+                      "offloadedEncodes": 0,
+                      "inlineDecodes": 0,
+                      "offloadedDecodes": 0,
+                      "offloadedBytes": 0}
+
+    def _getPool(self):
+        if self.pool is None:
+            self.pool = threadpool.ThreadPool(0, self.maxThreads,
+                                              "txes-json")
+            self.pool.start()
+            self.trigger = reactor.addSystemEventTrigger("during",
+                                                         "shutdown",
+                                                         self._shutdown)
+        return self.pool
+
+    def _shutdown(self):
+        self.trigger = None
+        self.stop()
+
+    def stop(self):
+        """
+        Stop the thread pool, it is started again by the next offloaded
+        payload
+        """
+        if self.trigger is not None:
+            reactor.removeSystemEventTrigger(self.trigger)
+            self.trigger = None
+        if self.pool is not None:
+            pool, self.pool = self.pool, None
+            pool.stop()
+
+    def shouldOffload(self, obj):
+        if self.threshold is None:
+            return False
+        return estimateSize(obj, self.threshold) >= self.threshold
+
+    def encodeLater(self, obj):
+        def count(data):
+            self.stats["offloadedBytes"] += len(data)
+            return data
+
+        if not self.shouldOffload(obj):
+            self.stats["inlineEncodes"] += 1
+            return defer.maybeDeferred(self.encode, obj)
+
+        self.stats["offloadedEncodes"] += 1
+        d = threads.deferToThreadPool(reactor, self._getPool(),
+                                      self.encode, obj)
+        d.addCallback(count)
+        return d
+
+    def decodeLater(self, data):
+        if self.threshold is None or len(data) < self.threshold:
+            self.stats["inlineDecodes"] += 1
+            return defer.maybeDeferred(self.decode, data)
+
+        self.stats["offloadedDecodes"] += 1
+        self.stats["offloadedBytes"] += len(data)
+        return threads.deferToThreadPool(reactor, self._getPool(),
+                                         self.decode, data)
@@ -0,0 +1,139 @@
+import re
+
+
+TOKENS = re.compile(r'["{}\[\],]')
+STRING_TOKENS = re.compile(r'["\\]')
+
+
+class HitStream(object):
+    """
+    Incrementally scan a search response as it arrives and hand every
+    entry of the hits.hits array to hitCallback as soon as it is complete.
+
+    Only the hit being received is buffered, the rest of the response is
+    kept and decoded by finish() with an empty hits.hits array.
+    """
+    def __init__(self, hitCallback, decode, path=("hits", "hits")):
+        self.hitCallback = hitCallback
+        self.decode = decode
+        self.path = list(path)
+        self.buffer = ""
+        self.pos = 0
+        self.inString = False
+        self.stringStart = None
+        self.expectKey = False
+        self.stack = []
+        self.prefix = None
+        self.suffix = []
+        self.depth = 0
+        self.start = None
+
+    def feed(self, data):
+        if self.suffix:
+            self.suffix.append(data)
+            return
+
+        self.buffer += data
+        if self.prefix is None:
+            self._scanPrefix()
+        if self.prefix is not None:
+            self._scanHits()
+
+    def finish(self):
+        """
+        Decode what remains of the response
+        """
+        if self.prefix is None:
+            return self.decode(self.buffer)
+        return self.decode(self.prefix + "".join(self.suffix))
+
+    def _skipString(self):
+        while True:
+            match = STRING_TOKENS.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                return False
+            if match.group() == "\\":
+                if match.end() >= len(self.buffer):
+                    self.pos = match.start()
+                    return False
+                self.pos = match.end() + 1
+                continue
+            self.pos = match.end()
+            self.inString = False
+            return True
+
+    def _scanPrefix(self):
+        while True:
+            if self.inString:
+                if not self._skipString():
+                    return
+                if self.expectKey and self.stack:
+                    key = self.buffer[self.stringStart + 1:self.pos - 1]
+                    self.stack[-1][1] = key
+                    self.expectKey = False
+                continue
+
+            match = TOKENS.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                return
+            token = match.group()
+            self.pos = match.end()
+
+            if token == '"':
+                self.inString = True
+                self.stringStart = match.start()
+            elif token == "{":
+                self.stack.append(["{", None])
+                self.expectKey = True
+            elif token == "[":
+                keys = [key for kind, key in self.stack if kind == "{"]
+                if len(self.stack) == len(self.path) and keys == self.path:
+                    self.prefix = self.buffer[:self.pos]
+                    self.buffer = self.buffer[self.pos:]
+                    self.pos = 0
+                    return
+                self.stack.append(["[", None])
+            elif token in "}]":
+                self.stack.pop()
+            elif token == ",":
+                self.expectKey = bool(self.stack) and self.stack[-1][0] == "{"
+
+    def _scanHits(self):
+        while True:
+            if self.inString:
+                if not self._skipString():
+                    break
+                continue
+
+            match = TOKENS.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                break
+            token = match.group()
+            self.pos = match.end()
+
+            if token == '"':
+                self.inString = True
+            elif token in "{[":
+                if not self.depth:
+                    self.start = match.start()
+                self.depth += 1
+            elif token in "}]":
+                if not self.depth:
+                    self.suffix.append(self.buffer[match.start():])
+                    self.buffer = ""
+                    self.pos = 0
+                    return
+                self.depth -= 1
+                if not self.depth:
+                    hit = self.buffer[self.start:self.pos]
+                    self.hitCallback(self.decode(hit))
+
+        keep = self.pos
+        if self.depth:
+            keep = self.start
+            self.start = 0
+        self.buffer = self.buffer[keep:]
+        self.pos -= keep
@@ -0,0 +1,148 @@
+import bisect
+
+from twisted.internet import task
+from twisted.python import log
+
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10)
+
+
+def endpointName(method, path):
+    """
+    Return the name metrics are kept under for a request, the method
+    followed by the API the path points at such as "GET _search"
+    """
+    path = path.split('?', 1)[0]
+    parts = [part for part in path.split('/') if part]
+    for i, part in enumerate(parts):
+        if part.startswith('_'):
+            return "%s %s" % (method, '/'.join(parts[i:]))
+    if not parts:
+        return "%s /" % method
+    if len(parts) == 1:
+        return "%s index" % method
+    return "%s document" % method
+
+
+class Histogram(object):
+    """
+    Count values in fixed buckets, percentiles are estimated as the upper
+    bound of the bucket they fall in
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, percent):
+        if not self.count:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        buckets = zip(self.buckets + (float("inf"),), self.counts)
+        return {"count": self.count,
+                "sum": self.sum,
+                "buckets": buckets,
+                "p50": self.percentile(50),
+                "p90": self.percentile(90),
+                "p99": self.percentile(99)}
+
+
+class Metrics(object):
+    """
+    Counters, gauges and per-endpoint request statistics of a client.
+
+    Gauges are functions called when a snapshot is taken, so they cost
+    nothing in between. Exporters are called with a snapshot every
+    interval seconds.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.endpoints = {}
+        self.exporters = []
+
+    def increment(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def addGauge(self, name, gauge):
+        self.gauges[name] = gauge
+
+    def record(self, endpoint, elapsed, failed=False):
+        """
+        Count a request to endpoint and its response time
+        """
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {"requests": 0,
+                                                "errors": 0,
+                                                "latency": Histogram()}
+        stats["requests"] += 1
+        if failed:
+            stats["errors"] += 1
+        stats["latency"].observe(elapsed)
+
+    def snapshot(self):
+        """
+        Return the current value of every metric
+        """
+        gauges = {}
+        for name, gauge in self.gauges.iteritems():
+            try:
+                gauges[name] = gauge()
+            except Exception:
+                log.err(None, "Failed to read gauge %s" % name)
+
+        endpoints = {}
+        for endpoint, stats in self.endpoints.iteritems():
+            endpoints[endpoint] = {"requests": stats["requests"],
+                                   "errors": stats["errors"],
+                                   "latency": stats["latency"].snapshot()}
+
+        return {"counters": dict(self.counters),
+                "gauges": gauges,
+                "endpoints": endpoints}
+
+    def addExporter(self, exporter, interval=10):
+        """
+        Call exporter with a snapshot every interval seconds
+        """
+        def export():
+            try:
+                exporter(self.snapshot())
+            except Exception:
+                log.err(None, "Metrics exporter failed")
+
+        self.removeExporter(exporter)
+        call = task.LoopingCall(export)
+        self.exporters.append((exporter, call))
+        call.start(interval, now=False)
+
+    def removeExporter(self, exporter):
+        for added, call in list(self.exporters):
+            if added == exporter:
+                self.exporters.remove((added, call))
+                if call.running:
+                    call.stop()
+
+    def stop(self):
+        """
+        Stop all of the exporters
+        """
+        for exporter, call in list(self.exporters):
+            self.removeExporter(exporter)
@@ -0,0 +1,255 @@
+import collections
+
+from twisted.internet import defer
+from twisted.python import failure
+
+
+class PageIterator(object):
+    """
+    Common helpers for iterators whose next() returns a deferred page
+    """
+    def __iter__(self):
+        return self
+
+    def each(self, callback):
+        """
+        Call callback with every hit of every page, waiting on it when it
+        returns a deferred.
+
+        Returns a deferred which fires with the number of hits once the
+        scroll is exhausted. If the callback fails the scroll context is
+        cleared and the deferred fails with the error.
+        """
+        count = [0]
+
+        @defer.inlineCallbacks
+        def run():
+            while not self.closed:
+                try:
+                    page = yield self.next()
+                except StopIteration:
+                    break
+                if page is None:
+                    break
+                for hit in page["hits"]["hits"]:
+                    yield callback(hit)
+                    count[0] += 1
+            defer.returnValue(count[0])
+
+        def stop(reason):
+            d = self.close()
+            d.addBoth(lambda _: reason)
+            return d
+
+        d = run()
+        d.addErrback(stop)
+        return d
+
+
+class Scroller(PageIterator):
+    """
+    Iterate over the pages of a scroll search.
+
+    Up to prefetch pages are fetched ahead of the consumer, so the next
+    page is usually already there when next() is called. Each call to
+    next() returns a deferred which fires with the next page of results
+    or None once the scroll is exhausted.
+
+    With a hitCallback every hit is handed to it as it is received and the
+    pages only carry the rest of the response.
+    """
+    def __init__(self, es, results, scrollTimeout="10m", prefetch=1,
+                 hitCallback=None):
+        self.es = es
+        self.scrollId = results.get("_scroll_id")
+        self.scrollTimeout = scrollTimeout
+        self.prefetch = max(prefetch, 1)
+        self.hitCallback = hitCallback
+        self.pages = collections.deque()
+        self.waiting = collections.deque()
+        self.fetching = None
+        self.done = False
+        self.closed = False
+
+        hits = results.get("hits", {}).get("hits", [])
+        if hits:
+            if hitCallback:
+                for hit in hits:
+                    hitCallback(hit)
+                del hits[:]
+            self.pages.append(results)
+        self._fill()
+
+    def _fill(self):
+        if self.fetching or self.done or self.closed:
+            return
+        if len(self.pages) >= self.prefetch:
+            return
+
+        streamed = [0]
+
+        def countHit(hit):
+            streamed[0] += 1
+            self.hitCallback(hit)
+
+        def gotPage(results):
+            self.fetching = None
+            self.scrollId = results.get("_scroll_id", self.scrollId)
+            if not streamed[0] and not results["hits"]["hits"]:
+                self.done = True
+            else:
+                self.pages.append(results)
+            self._deliver()
+
+        def failed(reason):
+            self.fetching = None
+            self.done = True
+            self.pages.append(reason)
+            self._deliver()
+
+        hitCallback = None
+        if self.hitCallback:
+            hitCallback = countHit
+
+        self.fetching = self.es._sendRequest("GET", "/_search/scroll",
+                                             body=self.scrollId,
+                                             params={"scroll":
+                                                     self.scrollTimeout},
+                                             hitCallback=hitCallback)
+        self.fetching.addCallbacks(gotPage, failed)
+
+    def _deliver(self):
+        while self.waiting and (self.pages or self.done):
+            d = self.waiting.popleft()
+            if not self.pages:
+                d.callback(None)
+            elif isinstance(self.pages[0], failure.Failure):
+                d.errback(self.pages.popleft())
+            else:
+                d.callback(self.pages.popleft())
+        self._fill()
+
+    def next(self):
+        """
+        Return a deferred firing with the next page or None at the end
+        """
+        if self.closed or (self.done and not self.pages):
+            raise StopIteration
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._deliver()
+        return d
+
+    def close(self):
+        """
+        Stop scrolling and clear the scroll context on the server
+        """
+        if self.closed:
+            return defer.succeed(None)
+        self.closed = True
+
+        while self.waiting:
+            self.waiting.popleft().callback(None)
+        self.pages.clear()
+
+        if self.done or not self.scrollId:
+            return defer.succeed(None)
+
+        def clear(_):
+            return self.es.clearScroll(self.scrollId)
+
+        def fetched(result):
+            d.callback(None)
+            return result
+
+        if self.fetching:
+            d = defer.Deferred()
+            self.fetching.addBoth(fetched)
+        else:
+            d = defer.succeed(None)
+        d.addCallback(clear)
+        return d
+
+
+class MultiScroller(PageIterator):
+    """
+    Merge the pages of several scrollers running concurrently.
+
+    next() fires with whichever page arrives first. A scroller is asked
+    for its next page once its previous one has been consumed, so each
+    of them stays within its own prefetch limit.
+    """
+    def __init__(self, scrollers):
+        self.scrollers = list(scrollers)
+        self.pages = collections.deque()
+        self.waiting = collections.deque()
+        self.active = set()
+        self.closed = False
+
+        for scroller in self.scrollers:
+            self._pull(scroller)
+
+    def _pull(self, scroller):
+        def gotPage(page):
+            self.active.discard(scroller)
+            if page is not None:
+                self.pages.append((scroller, page))
+            self._deliver()
+
+        def failed(reason):
+            self.active.discard(scroller)
+            self.pages.append((scroller, reason))
+            self._deliver()
+
+        if self.closed:
+            return
+        try:
+            d = scroller.next()
+        except StopIteration:
+            return
+        self.active.add(scroller)
+        d.addCallbacks(gotPage, failed)
+
+    def _deliver(self):
+        while self.waiting and (self.pages or not self.active):
+            d = self.waiting.popleft()
+            if not self.pages:
+                d.callback(None)
+                continue
+            scroller, page = self.pages.popleft()
+            if isinstance(page, failure.Failure):
+                d.errback(page)
+            else:
+                d.callback(page)
+                self._pull(scroller)
+
+    def next(self):
+        """
+        Return a deferred firing with the next page from any of the
+        scrollers or None once all of them are exhausted
+        """
+        if self.closed or (not self.pages and not self.active):
+            raise StopIteration
+
+        d = defer.Deferred()
+        self.waiting.append(d)
+        self._deliver()
+        return d
+
+    def close(self):
+        """
+        Stop all of the scrollers and clear their scroll contexts
+        """
+        if self.closed:
+            return defer.succeed(None)
+        self.closed = True
+
+        while self.waiting:
+            self.waiting.popleft().callback(None)
+        self.pages.clear()
+
+        ds = [scroller.close() for scroller in self.scrollers]
+        d = defer.DeferredList(ds, consumeErrors=True)
+        d.addCallback(lambda _: None)
+        return d
@@ -0,0 +1,88 @@
+import time
+
+
+PHASES = ("encode", "queue", "connect", "wait", "transfer", "decode")
+
+
+class Span(object):
+    """
+    Timings of a single attempt at sending a request to a server.
+
+    Each call to mark ends a phase, its duration is the time elapsed since
+    the previous mark:
+
+     - queue: waiting for a free connection slot of the server
+     - connect: getting a connection from the pool or opening one
+     - wait: sending the request and waiting for the response headers
+     - transfer: receiving the response body
+     - decode: decoding the JSON response
+    """
+    def __init__(self, server):
+        self.server = server
+        self.started = time.time()
+        self.last = self.started
+        self.phases = {}
+        self.responseBytes = 0
+
+    def mark(self, phase):
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+
+class Trace(object):
+    """
+    Timings of a request sent through HTTPConnection.execute, with a span
+    for every attempt made to send it, retries and hedges included
+    """
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.finished = None
+        self.encoded = None
+        self.requestBytes = None
+        self.spans = []
+        self.span = None
+        self.error = None
+
+    def startSpan(self, server):
+        span = Span(server)
+        self.spans.append(span)
+        return span
+
+    @property
+    def duration(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def server(self):
+        if self.span is not None:
+            return self.span.server
+
+    @property
+    def phases(self):
+        """
+        The time spent encoding the request and in each phase of the
+        attempt which got the response, or the last one
+        """
+        phases = {}
+        if self.encoded is not None:
+            phases["encode"] = self.encoded - self.started
+        span = self.span or (self.spans and self.spans[-1])
+        if span:
+            phases.update(span.phases)
+        return phases
+
+    def __str__(self):
+        phases = self.phases
+        timings = " ".join(["%s=%.1fms" % (phase, phases[phase] * 1000)
+                            for phase in PHASES if phase in phases])
+        responseBytes = None
+        if self.span is not None:
+            responseBytes = self.span.responseBytes
+        return ("%s %s on %s took %.1fms (%s) sent=%s received=%s "
+                "attempts=%d" % (self.method, self.path, self.server,
+                                 self.duration * 1000, timings,
+                                 self.requestBytes, responseBytes,
+                                 len(self.spans)))
@@ -1,27 +1,382 @@
-import time
+import collections
+import copy
 import random
 
+from twisted.internet import defer, reactor
+from twisted.python import failure
+
 from txes import exceptions
 
 
+class Balancer(object):
+    """
+    Pick a server at random.
+
+    Subclasses override choose and may use the in-flight counts and the
+    response times fed back through started and finished. finished is
+    told whether the request failed, elapsed is None for a request that
+    was cancelled before it got an answer.
+    """
+    def __init__(self):
+        self.inFlight = {}
+
+    def choose(self, servers):
+        return random.choice(servers)
+
+    def started(self, server):
+        self.inFlight[server] = self.inFlight.get(server, 0) + 1
+
+    def finished(self, server, elapsed, failed=False):
+        self.inFlight[server] = max(self.inFlight.get(server, 0) - 1, 0)
+
+
+class RoundRobinBalancer(Balancer):
+    """
+    Pick each server in turn
+    """
+    def __init__(self):
+        Balancer.__init__(self)
+        self.counter = 0
+
+    def choose(self, servers):
+        self.counter += 1
+        return servers[self.counter % len(servers)]
+
+
+class LeastOutstandingBalancer(Balancer):
+    """
+    Pick the server with the fewest requests in flight
+    """
+    def choose(self, servers):
+        least = min([self.inFlight.get(s, 0) for s in servers])
+        return random.choice([s for s in servers
+                              if self.inFlight.get(s, 0) == least])
+
+
+class EWMABalancer(Balancer):
+    """
+    Pick the cheaper of two random servers, where the cost of a server is
+    the moving average of its response times scaled by the number of
+    requests it has in flight.
+
+    A failed request counts as taking at least failurePenalty seconds so
+    that a server answering errors quickly does not look cheap.
+    """
+    def __init__(self, alpha=0.3, failurePenalty=1.0):
+        Balancer.__init__(self)
+        self.alpha = alpha
+        self.failurePenalty = failurePenalty
+        self.latency = {}
+
+    def cost(self, server):
+        inFlight = self.inFlight.get(server, 0)
+        return self.latency.get(server, 0.0) * (inFlight + 1)
+
+    def choose(self, servers):
+        if len(servers) == 1:
+            return servers[0]
+        first, second = random.sample(servers, 2)
+        if self.cost(second) < self.cost(first):
+            return second
+        return first
+
+    def finished(self, server, elapsed, failed=False):
+        Balancer.finished(self, server, elapsed, failed)
+        if elapsed is None:
+            return
+        if failed:
+            elapsed = max(elapsed, self.failurePenalty)
+        if server not in self.latency:
+            self.latency[server] = elapsed
+        else:
+            self.latency[server] += self.alpha * (elapsed -
+                                                  self.latency[server])
+
+
+BALANCERS = {"random": Balancer,
+             "roundrobin": RoundRobinBalancer,
+             "leastoutstanding": LeastOutstandingBalancer,
+             "ewma": EWMABalancer}
+
+
+def getBalancer(balancer=None):
+    """
+    Return a balancer from its name in BALANCERS or the balancer itself
+    """
+    if balancer is None:
+        balancer = "random"
+    if isinstance(balancer, basestring):
+        if balancer not in BALANCERS:
+            raise ValueError("Invalid balancer: %s" % balancer)
+        return BALANCERS[balancer]()
+    return balancer
+
+
+class Budget(object):
+    """
+    Allow extra requests, such as retries or hedges, for at most ratio of
+    the requests, with a reserve so that the first ones are allowed too
+    """
+    def __init__(self, ratio=0.1, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = float(reserve)
+
+    def request(self):
+        self.tokens = min(self.tokens + self.ratio, self.reserve)
+
+    def withdraw(self):
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class LatencyWindow(object):
+    """
+    Keep the last size response times to compute percentiles over them.
+
+    The sorted samples are only rebuilt after a tenth of the window has
+    been replaced.
+    """
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+        self.sorted = []
+        self.stale = 0
+
+    def add(self, elapsed):
+        self.samples.append(elapsed)
+        self.stale += 1
+
+    def percentile(self, percent):
+        if not self.samples:
+            return None
+        if not self.sorted or self.stale * 10 >= self.samples.maxlen:
+            self.sorted = sorted(self.samples)
+            self.stale = 0
+        index = int(len(self.sorted) * percent / 100.0)
+        return self.sorted[min(index, len(self.sorted) - 1)]
+
+
+class SingleFlight(object):
+    """
+    Share a single call between the callers asking for the same key while
+    it is in flight.
+
+    Every caller gets its own deferred and, but for the last one, its own
+    copy of the result. The call is only cancelled once all of its callers
+    have cancelled.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.shared = 0
+
+    def call(self, key, f, *args, **kwargs):
+        def cancel(waiter):
+            waiters, d = self.calls[key]
+            waiters.remove(waiter)
+            if not waiters:
+                d.cancel()
+
+        def fire(result, waiters):
+            del self.calls[key]
+            if isinstance(result, failure.Failure):
+                for waiter in waiters:
+                    waiter.errback(result)
+                return
+
+            # Copy before firing anyone, a caller may change its result
+            results = [copy.deepcopy(result) for _ in waiters[1:]]
+            results.append(result)
+            for waiter, value in zip(waiters, results):
+                waiter.callback(value)
+
+        waiter = defer.Deferred(cancel)
+        if key in self.calls:
+            self.shared += 1
+            self.calls[key][0].append(waiter)
+            return waiter
+
+        waiters = [waiter]
+        d = defer.maybeDeferred(f, *args, **kwargs)
+        self.calls[key] = (waiters, d)
+        d.addBoth(fire, waiters)
+        return waiter
+
+
+class CircuitBreaker(object):
+    """
+    Track the state of a single server.
+
+    A closed breaker lets requests through. It opens after maxFailures
+    failures in a row, and the server then gets no traffic until a probe
+    in the half-open state succeeds and closes it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, server, maxFailures=3):
+        self.server = server
+        self.maxFailures = maxFailures
+        self.state = self.CLOSED
+        self.failures = 0
+        self.call = None
+
+
 class ServerList(list):
-    def __init__(self, servers, retryTime=10):
-        list.__init__(self, servers)
-        self.dead = []
+    """
+    The servers currently taking traffic, along with a circuit breaker
+    for every known server.
+
+    When probe is given it is called with a server whose breaker is open
+    every retryTime seconds and must return a deferred, the breaker is
+    closed once it succeeds. Without a probe the breaker closes when
+    retryTime has elapsed.
+    """
+    def __init__(self, servers, retryTime=10, maxFailures=3, balancer=None,
+                 probe=None):
+        list.__init__(self)
         self.retryTime = retryTime
+        self.maxFailures = maxFailures
+        self.balancer = getBalancer(balancer)
+        self.probe = probe
+        self.breakers = {}
+        self.listeners = []
+        for server in servers:
+            self.add(server)
+
+    @property
+    def dead(self):
+        return [server for server, breaker in self.breakers.iteritems()
+                if breaker.state != CircuitBreaker.CLOSED]
+
+    def add(self, server):
+        if server in self.breakers:
+            return
+        self.breakers[server] = CircuitBreaker(server, self.maxFailures)
+        self.append(server)
+
+    def discard(self, server):
+        """
+        Forget about server, requests already sent to it are not affected
+        """
+        breaker = self.breakers.pop(server, None)
+        if breaker is None:
+            return
+        if breaker.call and breaker.call.active():
+            breaker.call.cancel()
+        if server in self:
+            self.remove(server)
 
-    def get(self):
-        if self.dead:
-            retryTime, server = self.dead.pop()
-            if retryTime > time.time():
-                self.dead.append((retryTime, server))
-            else:
-                self.append(server)
+    def update(self, servers):
+        """
+        Add the new servers and drop the ones missing from servers
+        """
+        for server in servers:
+            self.add(server)
+        for server in list(self.breakers):
+            if server not in servers:
+                self.discard(server)
+
+    def get(self, exclude=None):
+        """
+        Return a live server, preferring the ones not in exclude
+        """
         if not self:
             raise exceptions.NoServerAvailable()
 
-        return random.choice(self)
+        servers = self
+        if exclude:
+            servers = [s for s in self if s not in exclude] or self
+        return self.balancer.choose(servers)
+
+    def started(self, server):
+        self.balancer.started(server)
+
+    def finished(self, server, elapsed, failed=False):
+        self.balancer.finished(server, elapsed, failed)
+
+    def addStateListener(self, listener):
+        """
+        Call listener with (server, oldState, newState) whenever the
+        circuit breaker of a server changes state
+        """
+        self.listeners.append(listener)
+
+    def removeStateListener(self, listener):
+        self.listeners.remove(listener)
+
+    def _setState(self, breaker, state):
+        oldState = breaker.state
+        if oldState == state:
+            return
+        breaker.state = state
+        if state == CircuitBreaker.CLOSED:
+            breaker.failures = 0
+            if breaker.server not in self:
+                self.append(breaker.server)
+        elif breaker.server in self:
+            self.remove(breaker.server)
+        for listener in list(self.listeners):
+            listener(breaker.server, oldState, state)
+
+    def _open(self, breaker):
+        self._setState(breaker, CircuitBreaker.OPEN)
+        if not breaker.call or not breaker.call.active():
+            breaker.call = reactor.callLater(self.retryTime, self._halfOpen,
+                                             breaker)
+
+    def _halfOpen(self, breaker):
+        def current():
+            # The server may have been discarded while it was probed
+            return (self.breakers.get(breaker.server) is breaker and
+                    breaker.state == CircuitBreaker.HALF_OPEN)
+
+        def succeeded(_):
+            if current():
+                self._setState(breaker, CircuitBreaker.CLOSED)
+
+        def failed(_):
+            if current():
+                self._open(breaker)
+
+        breaker.call = None
+        if self.probe is None:
+            self._setState(breaker, CircuitBreaker.CLOSED)
+            return
+
+        self._setState(breaker, CircuitBreaker.HALF_OPEN)
+        d = defer.maybeDeferred(self.probe, breaker.server)
+        d.addCallbacks(succeeded, failed)
 
     def markDead(self, server):
-        self.remove(server)
-        self.dead.insert(0, (time.time() + self.retryTime, server))
+        breaker = self.breakers.get(server)
+        if breaker and breaker.state == CircuitBreaker.CLOSED:
+            self._open(breaker)
+
+    def markFailed(self, server):
+        """
+        Count a failed request, the breaker of the server opens after
+        maxFailures failures in a row
+        """
+        breaker = self.breakers.get(server)
+        if not breaker:
+            return
+        breaker.failures += 1
+        if breaker.failures >= breaker.maxFailures:
+            self.markDead(server)
+
+    def markOk(self, server):
+        breaker = self.breakers.get(server)
+        if breaker:
+            breaker.failures = 0
+
+    def stop(self):
+        """
+        Cancel the pending probes
+        """
+        for breaker in self.breakers.itervalues():
+            if breaker.call and breaker.call.active():
+                breaker.call.cancel()
+            breaker.call = None